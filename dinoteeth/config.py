@@ -54,6 +54,8 @@ class Config(object):
         parser.add_argument("--test-threads", action="store_true", default=False)
         parser.add_argument("--test-menu", action="store_true", default=False)
         parser.add_argument("--test-menu-search", action="store", default="")
+        parser.add_argument("--full", action="store_true", default=False,
+                    help="Update monitor rebuilds metadata for all files rather than only changed files")
         
         # commands that can override settings in the [default] section; defaults
         # are provided by the configspec set in settings.default_conf
@@ -145,7 +147,7 @@ class Config(object):
             setattr(settings, k, getattr(self.options, k))
         
         # parameters in other sections are only specified through config file
-        for section in ["window", "fonts", "metadata", "metadata providers", "posters"]:
+        for section in ["window", "scan", "fonts", "metadata", "metadata providers", "posters"]:
             user = dict(ini[section])
 #            print "user [%s]: %s" % (section, user)
             known = dict(configspec[section])
@@ -185,7 +187,9 @@ class Config(object):
             
 #            event_callback = self.main_window.get_event_callback('on_status_update')
             event_callback = self.main_window.get_event_callback('on_timer_tick')
-            UpdateManager(event_callback, self.db, self.get_thumbnail_loader())
+            timer_callback = self.main_window.get_event_callback('on_timer')
+            UpdateManager(event_callback, self.db, self.get_thumbnail_loader(),
+                          timer_callback)
             if self.options.test_threads:
                 UpdateManager.test()
         return self.main_window
@@ -237,7 +241,7 @@ class Config(object):
             if settings.media_root and not os.path.isabs(path):
                 path = os.path.join(settings.media_root, path)
             watcher.add_path(path, flags)
-        watcher.watch()
+        watcher.watch(self.options.full)
     
     def get_subtitle_extensions(self):
         return [".srt", ".ssa", ".ass"]
@@ -258,7 +262,8 @@ class Config(object):
         return settings.font_size_selected
     
     def get_thumbnail_loader(self):
-        thumbnail_factory = ThumbnailFactory(settings.thumbnail_dir, self.get_metadata_pathname(settings.image_dir))
+        thumbnail_factory = ThumbnailFactory(settings.thumbnail_dir, self.get_metadata_pathname(settings.image_dir),
+                                             mosaic_cache_bytes=settings.mosaic_disk_cache_size * 1024 * 1024)
         return thumbnail_factory
     
     def get_media_client(self, media_file):
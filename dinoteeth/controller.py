@@ -36,6 +36,12 @@ class VerticalMenuController(object):
             menu.move_cursor(delta)
             return True
         
+        # Other keys like audio or subtitle selection can change the details
+        # of the selected item without moving the cursor, so the detail is
+        # redrawn.  Moving the cursor only redraws the detail if the selected
+        # item changes.
+        self.layout.mark_changed("detail")
+        
         if keycode == k.RIGHT or keycode == k.KP_ENTER or keycode == k.RETURN:
             self.process_select()
         elif keycode == k.LEFT:
@@ -167,7 +173,7 @@ class VerticalMenuController(object):
             self.search_string += c
             
         populator.set_search_text(self.search_string)
-        menu.needs_refresh()
+        menu.invalidate()
         self.layout.refresh()
         self.last_keypress = time.time()
     
@@ -177,7 +183,7 @@ class VerticalMenuController(object):
             menu = self.layout.get_menu()
             populator = menu.populate_children
             populator.set_search_text(self.search_string)
-            menu.needs_refresh()
+            menu.invalidate()
             self.layout.refresh()
         else:
             self.process_back()
@@ -1,15 +1,27 @@
-import os, time, collections, logging
+import os, time, calendar, collections, logging, itertools, multiprocessing
 
 import transaction
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from persistent import Persistent
+from persistent.list import PersistentList
 
-from utils import iter_dir
-from filescan import MediaFile
+from utils import iter_dir_stat
+from filescan import MediaFile, probe_worker
 from metadata import MetadataLoader
+import settings
 
 log = logging.getLogger("dinoteeth.database")
 
 
 class StaticFileList(list):
+    def sort(self, cmp=None, key=None, reverse=False):
+        """Sort using the media files' cached sort keys unless a different
+        comparison is specified
+        """
+        if cmp is None and key is None:
+            key = MediaFile.sort_key
+        list.sort(self, cmp=cmp, key=key, reverse=reverse)
+    
     def __str__(self):
         lines = []
         for item in self:
@@ -38,7 +50,7 @@ class StaticFileList(list):
             except AttributeError:
                 if season_number == 0:
                     episodes.append(m)
-        episodes.sort()
+        episodes.sort(key=MediaFile.sort_key)
         return episodes
     
     def get_bonus(self, season_number=-1):
@@ -46,7 +58,7 @@ class StaticFileList(list):
         for m in self:
             if (season_number < 0 or m.scan.season == season_number) and m.scan.is_bonus:
                 bonus.append(m)
-        bonus.sort()
+        bonus.sort(key=MediaFile.sort_key)
         return bonus
     
     def get_total_runtime(self):
@@ -123,75 +135,611 @@ class StaticFileList(list):
         return slist
     
 class FilteredFileList(StaticFileList):
+    """List of media files that is filtered lazily.
+    
+    Filtering doesn't create a chain of nested lists; instead, the new list
+    shares the unfiltered base list and extends the parent's list of
+    predicates.  All the predicates are applied in a single pass over the
+    base list the first time the results are needed, and the results are
+    cached along with the unique metadata grouping.
+    
+    The base list (without any predicates) can still be changed; each change
+    increments its version, which discards the cached results of the
+    filtered lists sharing it.
+    """
     def __init__(self, parent=None, filter_callable=None, *args, **kwargs):
         list.__init__(self, *args, **kwargs)
-        self.parent = parent
-        if filter_callable is None:
-            filter_callable = lambda x: True
-        self.filter_callable = filter_callable
+        if parent is None:
+            self.base = self
+            self.predicates = []
+            self.version = 0
+        else:
+            self.base = parent.base
+            self.predicates = list(parent.predicates)
+        if filter_callable is not None:
+            self.predicates.append(filter_callable)
+        self.results = None
+        self.unique_metadata = None
+        self.cached_version = None
+    
+    def base_changed(self):
+        self.base.version += 1
+    
+    def append(self, item):
+        list.append(self, item)
+        self.base_changed()
+    
+    def extend(self, items):
+        list.extend(self, items)
+        self.base_changed()
+    
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self.base_changed()
+    
+    def remove(self, item):
+        list.remove(self, item)
+        self.base_changed()
+    
+    def pop(self, *args):
+        self.base_changed()
+        return list.pop(self, *args)
+    
+    def sort(self, *args, **kwargs):
+        StaticFileList.sort(self, *args, **kwargs)
+        self.base_changed()
+    
+    def reverse(self):
+        list.reverse(self)
+        self.base_changed()
+    
+    def __setitem__(self, index, item):
+        list.__setitem__(self, index, item)
+        self.base_changed()
+    
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.base_changed()
+    
+    def __setslice__(self, i, j, items):
+        list.__setslice__(self, i, j, items)
+        self.base_changed()
+    
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.base_changed()
+    
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
         
     def filter(self, criteria):
         filtered = FilteredFileList(parent=self, filter_callable=criteria)
         return filtered
     
+    def check_cache(self):
+        """Discard the cached results if the base list has changed since
+        they were computed
+        """
+        if self.cached_version != self.base.version:
+            self.results = None
+            self.unique_metadata = None
+            self.cached_version = self.base.version
+    
+    def get_results(self):
+        if not self.predicates:
+            return list.__iter__(self.base)
+        self.check_cache()
+        if self.results is None:
+            predicates = self.predicates
+            results = []
+            for item in list.__iter__(self.base):
+                for predicate in predicates:
+                    if not predicate(item):
+                        break
+                else:
+                    results.append(item)
+            self.results = results
+        return self.results
+    
     def __iter__(self):
-        if self.parent is None:
-            index = 0
-            while True:
-                try:
-                    item = self[index]
-                    if self.filter_callable(item):
-                        yield item
-                except IndexError:
-                    raise StopIteration
-                index += 1
-        else:
-            for item in self.parent:
-                if self.filter_callable(item):
-                    yield item
+        return iter(self.get_results())
     
     def __len__(self):
-        if self.parent is None:
-            return list.__len__(self)
-        else:
-            count = 0
-            for item in self:
-                count += 1
-            return count
+        if not self.predicates:
+            return list.__len__(self.base)
+        return len(self.get_results())
+    
+    def get_unique_metadata(self):
+        if not self.predicates:
+            return StaticFileList.get_unique_metadata(self)
+        self.check_cache()
+        if self.unique_metadata is None:
+            self.unique_metadata = StaticFileList.get_unique_metadata(self)
+        return self.unique_metadata
+    
+    def static_list(self):
+        return StaticFileList(self.get_results())
+
+
+class CreditIndex(Persistent):
+    """Inverted index from the values of a metadata credit (e.g.  directors)
+    to the ids of the metadata objects having that value.
+    
+    Values that are shared persistent objects (people, companies, etc.) are
+    stored as the tuple (zodb_mapping_name, id); other values (strings,
+    years, etc.) are stored as is.
+    """
+    def __init__(self, credit):
+        self.credit = credit
+        
+        # value key -> set of metadata ids
+        self.metadata_ids = OOBTree()
+        
+        # metadata id -> tuple of value keys, used to unindex
+        self.indexed = OOBTree()
+    
+    @classmethod
+    def get_value_key(cls, value):
+        if hasattr(value, "zodb_mapping_name"):
+            return (value.zodb_mapping_name, value.id)
+        return value
+    
+    def get_value(self, db, key):
+        """Return the credit value corresponding to the value key
+        """
+        if isinstance(key, tuple):
+            name, id = key
+            return db.zodb.get_mapping(name).get(id, None)
+        return key
+    
+    def get_value_keys(self, metadata_id):
+        return self.indexed.get(metadata_id, ())
+    
+    def index(self, metadata):
+        self.unindex(metadata.id)
+        if not hasattr(metadata, "iter_items_of") or getattr(metadata, self.credit, None) is None:
+            return
+        keys = []
+        for value in metadata.iter_items_of(self.credit):
+            key = self.get_value_key(value)
+            if key in keys:
+                continue
+            keys.append(key)
+            ids = self.metadata_ids.get(key, None)
+            if ids is None:
+                ids = OOTreeSet()
+                self.metadata_ids[key] = ids
+            ids.insert(metadata.id)
+        if keys:
+            self.indexed[metadata.id] = tuple(keys)
+    
+    def unindex(self, metadata_id):
+        keys = self.indexed.get(metadata_id, None)
+        if keys is None:
+            return
+        for key in keys:
+            ids = self.metadata_ids.get(key, None)
+            if ids is not None and metadata_id in ids:
+                ids.remove(metadata_id)
+                if len(ids) == 0:
+                    del self.metadata_ids[key]
+        del self.indexed[metadata_id]
+
+
+class DateIndex(Persistent):
+    """Time ordered index of metadata ids, e.g.  by date added or by the
+    last time any of the metadata's media files was played.
+    
+    Entries are stored as (-timestamp, id) so that iterating over the index
+    returns the most recent entries first.
+    
+    The play date index is written by both the UI (when a play position is
+    saved) and the update monitor (when metadata is looked up).  The BTrees
+    merge concurrent changes to different ids; changes to the same id raise
+    ConflictError, and the UI retries against the monitor's version.
+    """
+    def __init__(self):
+        self.entries = OOTreeSet()
+        self.times = OOBTree()
+    
+    def __len__(self):
+        return len(self.times)
+    
+    def index(self, id, timestamp):
+        """Set the time of the metadata id, or remove it from the index if
+        the timestamp is None or not positive
+        """
+        old = self.times.get(id, None)
+        if old == timestamp:
+            return
+        if old is not None:
+            if (-old, id) in self.entries:
+                self.entries.remove((-old, id))
+            del self.times[id]
+        if timestamp is not None and timestamp > 0:
+            self.entries.insert((-timestamp, id))
+            self.times[id] = timestamp
+    
+    def get_time(self, id):
+        return self.times.get(id, None)
+    
+    def iter_newest(self, since=None):
+        """Generator returning (id, timestamp) tuples from newest to oldest
+        
+        @param since: if specified, stop at the first entry older than this
+        time
+        """
+        for negative_time, id in self.entries:
+            if since is not None and -negative_time < since:
+                break
+            yield id, -negative_time
+
+
+class TitleKeyMap(Persistent):
+    """Map of each title key to the list of media files having that title
+    key.
+    
+    Title keys have no ordering, so entries are stored in an OOBTree keyed
+    by the (category, subcategory, title, year) tuple of the title key.
+    Adding or removing a title key only stores the btree bucket that holds
+    it, and adding a media file to an existing title key only stores that
+    title key's list.
+    """
+    def __init__(self):
+        # key tuple -> (title key, PersistentList of media files)
+        self.entries = OOBTree()
+    
+    @classmethod
+    def get_key(cls, title_key):
+        title = title_key.title
+        if isinstance(title, str):
+            title = title.decode('utf-8', 'replace')
+        return (title_key.category, title_key.subcategory, title, title_key.year)
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, title_key):
+        return self.get_key(title_key) in self.entries
+    
+    def __getitem__(self, title_key):
+        return self.entries[self.get_key(title_key)][1]
+    
+    def get(self, title_key, default=None):
+        entry = self.entries.get(self.get_key(title_key), None)
+        if entry is None:
+            return default
+        return entry[1]
+    
+    def __setitem__(self, title_key, scans):
+        self.entries[self.get_key(title_key)] = (title_key, scans)
+    
+    def __delitem__(self, title_key):
+        del self.entries[self.get_key(title_key)]
+    
+    def keys(self):
+        return [title_key for title_key, scans in self.entries.itervalues()]
+    
+    def iteritems(self):
+        return self.entries.itervalues()
+    
+    def clear(self):
+        self.entries.clear()
+
+
+class TitleSearchIndex(object):
+    """Trigram index of metadata titles for case insensitive substring
+    searches.
+    
+    Searches of at least 3 characters only have to check the titles that
+    contain every trigram of the search text; shorter searches check every
+    title.  The results of a previous search can also be passed in as the
+    candidates when the search text has only been extended.
+    """
+    def __init__(self, metadata_iterable=[]):
+        self.titles = {}
+        self.trigrams = {}
+        for metadata in metadata_iterable:
+            self.add(metadata.id, metadata.title)
+    
+    @classmethod
+    def normalize(cls, text):
+        if not text:
+            return u""
+        if isinstance(text, str):
+            return text.decode('utf-8', 'replace').lower()
+        return unicode(text).lower()
+    
+    def add(self, id, title):
+        t = self.normalize(title)
+        self.titles[id] = t
+        for i in range(len(t) - 2):
+            trigram = t[i:i + 3]
+            if trigram not in self.trigrams:
+                self.trigrams[trigram] = set()
+            self.trigrams[trigram].add(id)
+    
+    def search(self, text, candidates=None):
+        """Return the set of ids whose titles contain the text
+        
+        @param candidates: optional set of ids to restrict the search, e.g.
+        the results of a search for a substring of the text
+        """
+        text = self.normalize(text)
+        if candidates is None:
+            if len(text) >= 3:
+                sets = []
+                for i in range(len(text) - 2):
+                    ids = self.trigrams.get(text[i:i + 3], None)
+                    if ids is None:
+                        return set()
+                    sets.append(ids)
+                sets.sort(key=len)
+                candidates = sets[0].intersection(*sets[1:])
+            else:
+                candidates = self.titles.iterkeys()
+        titles = self.titles
+        return set(id for id in candidates if id in titles and text in titles[id])
 
 
 class HomeTheaterDatabase(object):
+    root_mappings = ["scans", "metadata", "title_key_to_metadata",
+                     "dirty_title_keys", "date_indexes"]
+    root_btrees = ["category_index", "credit_index"]
+    
+    # Changes recorded with DBFacade.mark_changed that never affect titles;
+    # title_key and metadata changes may add or rename titles
+    title_neutral_changes = set(["starred", "play"])
+    
     def __init__(self, zodb):
         self.zodb = zodb
+        self.title_search_index = None
+        zodb.add_commit_callback(self.check_title_changes)
+        if self.is_missing_indexes():
+            self.create_indexes()
+        else:
+            self.open_root_objects()
+    
+    def open_root_objects(self):
+        zodb = self.zodb
         self.scans = zodb.get_mapping("scans")
         self.metadata = zodb.get_mapping("metadata")
         self.title_key_to_metadata = zodb.get_mapping("title_key_to_metadata")
-        self.zodb_title_key_map = zodb.get_mapping("title_key_map")
+        self.zodb_title_key_map = self.get_title_key_map_object()
+        self.category_index = zodb.get_btree("category_index")
+        self.dirty_title_keys = zodb.get_mapping("dirty_title_keys")
+        self.credit_index = zodb.get_btree("credit_index")
+        self.date_indexes = zodb.get_mapping("date_indexes")
+    
+    def is_missing_indexes(self):
+        """Check, without changing the database, if any of the root objects
+        or indexes need to be created
+        """
+        zodb = self.zodb
+        for name in self.root_mappings + self.root_btrees + ["title_key_btree"]:
+            if not zodb.exists(name):
+                return True
+        num_scans = len(zodb.get_mapping("scans"))
+        num_metadata = len(zodb.get_mapping("metadata"))
+        return ((len(zodb.get_btree("category_index")) == 0 and num_scans > 0) or
+                self.get_missing_credits(zodb.get_btree("credit_index")) or
+                len(zodb.get_mapping("date_indexes")) == 0 or
+                (len(zodb.get_value("title_key_btree", None)) == 0 and num_scans > 0))
+    
+    def create_indexes(self, retry=3):
+        """Create any missing root objects and indexes, and commit them
+        immediately.
+        
+        With ZEO, another client (usually the monitor process) may be doing
+        the same thing; if so, its indexes are used instead.  Clients that
+        find the indexes already present never write to the root objects, so
+        their later commits don't conflict on them.
+        """
+        while True:
+            self.open_root_objects()
+            if len(self.category_index) == 0 and len(self.scans) > 0:
+                self.create_category_index()
+            if self.get_missing_credits(self.credit_index):
+                self.create_credit_index()
+            if len(self.date_indexes) == 0:
+                self.create_date_indexes()
+            if len(self.zodb_title_key_map) == 0 and len(self.scans) > 0:
+                self.create_title_key_map()
+            try:
+                self.zodb.commit()
+                return
+            except self.zodb.conflict:
+                log.info("Conflict creating indexes; using the indexes from another client")
+                self.zodb.abort()
+                self.zodb.sync()
+                retry -= 1
+                if retry <= 0 or not self.is_missing_indexes():
+                    self.open_root_objects()
+                    return
     
     def pack(self):
         self.zodb.pack()
     
     def get_all(self, category):
 #        self.zodb.sync() # This is the major slowdown!
+        # The category index holds pathnames only, so none of the media files
+        # are unghosted here; that happens when the list is actually used.
         media_files = FilteredFileList()
-        for media_file in self.scans.itervalues():
-            scan = media_file.scan
-            if scan is not None and (category == "all" or scan.category == category):
-                media_files.append(media_file)
+        if category == "all":
+            buckets = self.category_index.values()
+        else:
+            buckets = [self.category_index.get(category, ())]
+        for pathnames in buckets:
+            for pathname in pathnames:
+                media_file = self.scans.get(pathname, None)
+                if media_file is not None:
+                    media_files.append(media_file)
         log.debug("Last modified: %s, # scans=%d" % (self.zodb.get_last_modified(), len(media_files)))
         return media_files
     
     def get(self, pathname):
         return self.scans[pathname]
     
+    def get_title_search_index(self):
+        """Return the L{TitleSearchIndex} of all metadata titles, rebuilding
+        it if titles may have changed since it was created.
+        
+        Titles are only changed when metadata is looked up, which sets the
+        last modified time (usually in the monitor process), or by local
+        commits that are checked by L{check_title_changes}.
+        """
+        last_modified = self.zodb.get_last_modified()
+        if self.title_search_index is None or self.title_search_index[0] != last_modified:
+            log.debug("Creating title search index for %d metadata objects" % len(self.metadata))
+            self.title_search_index = (last_modified, TitleSearchIndex(self.metadata.itervalues()))
+        return self.title_search_index[1]
+    
+    def check_title_changes(self, changes):
+        """Commit callback to discard the title search index unless all the
+        changes are known not to affect titles
+        """
+        for attr, id in changes:
+            if attr not in self.title_neutral_changes:
+                break
+        else:
+            if changes:
+                return
+        self.title_search_index = None
+    
     def get_metadata(self, imdb_id):
         return self.metadata.get(imdb_id, None)
     
-    def add(self, pathname, flags=""):
-        media_file = MediaFile(pathname, flags=flags)
+    def add(self, pathname, flags="", probed=None):
+        if pathname in self.scans:
+            self.unindex_media_file(self.scans[pathname])
+        media_file = MediaFile(pathname, flags=flags, probed=probed)
         self.scans[media_file.pathname] = media_file
+        self.index_media_file(media_file)
         return media_file
     
+    def remove(self, pathname):
+        media_file = self.scans[pathname]
+        self.unindex_media_file(media_file)
+        del self.scans[pathname]
+    
+    def create_category_index(self):
+        log.info("Creating category index for %d scans" % len(self.scans))
+        self.category_index.clear()
+        for media_file in self.scans.itervalues():
+            self.index_category(media_file)
+    
+    def get_missing_credits(self, credit_index):
+        """Return the credits in the credit map that don't have an index
+        """
+        return [credit for title, credit, limit, converter, reverse_sort in settings.credit_map if credit not in credit_index]
+    
+    def create_credit_index(self):
+        """Create and fill in the L{CreditIndex} of each credit in the credit
+        map that hasn't been indexed before
+        """
+        for credit in self.get_missing_credits(self.credit_index):
+            log.info("Creating %s credit index for %d metadata objects" % (credit, len(self.metadata)))
+            index = CreditIndex(credit)
+            self.credit_index[credit] = index
+            for metadata in self.metadata.itervalues():
+                index.index(metadata)
+    
+    def get_credit_index(self, credit):
+        """Return the L{CreditIndex} for the credit.
+        
+        All the credit indexes are created by L{create_indexes}, so this
+        never writes to the database; an unknown credit returns an empty
+        index that isn't stored.
+        """
+        index = self.credit_index.get(credit, None)
+        if index is None:
+            index = CreditIndex(credit)
+        return index
+    
+    def create_date_indexes(self):
+        log.info("Creating date indexes")
+        self.date_indexes.clear()
+        added = DateIndex()
+        for metadata in self.metadata.itervalues():
+            added.index(metadata.id, getattr(metadata, "date_added", None))
+        self.date_indexes["date_added"] = added
+        played = DateIndex()
+        for media_file in self.scans.itervalues():
+            self.index_play_date(media_file, played)
+        self.date_indexes["play_date"] = played
+    
+    def get_date_index(self, name):
+        """Return the L{DateIndex} for "date_added" or "play_date"
+        
+        The date indexes are created by L{create_indexes}, so this never
+        writes to the date_indexes mapping.
+        """
+        return self.date_indexes[name]
+    
+    def index_play_date(self, media_file, index=None):
+        """Update the play date index with the media file's play date if it
+        is the most recent play of any of the metadata's media files
+        """
+        if media_file.metadata is None or media_file.scan is None:
+            return
+        play_date = getattr(media_file.scan, "play_date", None)
+        if play_date is None:
+            return
+        if index is None:
+            index = self.get_date_index("play_date")
+        timestamp = calendar.timegm(play_date.utctimetuple())
+        last = index.get_time(media_file.metadata.id)
+        if last is None or timestamp > last:
+            index.index(media_file.metadata.id, timestamp)
+    
+    def set_last_position(self, media_file, last_pos=-1.0):
+        """Save the playback position of the media file, keeping the play
+        date index current as part of the same transaction
+        """
+        def before_commit():
+            self.index_play_date(media_file)
+            if media_file.metadata is not None:
+                self.zodb.mark_changed("play", media_file.metadata.id)
+        media_file.scan.set_last_position(last_pos, before_commit)
+    
+    def index_metadata(self, metadata):
+        self.zodb.mark_changed("metadata", metadata.id)
+        self.index_credits(metadata)
+        self.get_date_index("date_added").index(metadata.id, getattr(metadata, "date_added", None))
+    
+    def index_credits(self, metadata):
+        for title, credit, limit, converter, reverse_sort in settings.credit_map:
+            index = self.credit_index.get(credit, None)
+            if index is not None:
+                index.index(metadata)
+    
+    def index_media_file(self, media_file):
+        self.index_category(media_file)
+        self.index_title_key(media_file)
+    
+    def unindex_media_file(self, media_file):
+        self.unindex_category(media_file)
+        self.unindex_title_key(media_file)
+    
+    def index_category(self, media_file):
+        scan = media_file.scan
+        if scan is None:
+            return
+        pathnames = self.category_index.get(scan.category, None)
+        if pathnames is None:
+            pathnames = OOTreeSet()
+            self.category_index[scan.category] = pathnames
+        pathnames.insert(media_file.pathname)
+    
+    def unindex_category(self, media_file):
+        scan = media_file.scan
+        if scan is None:
+            return
+        pathnames = self.category_index.get(scan.category, None)
+        if pathnames is not None and media_file.pathname in pathnames:
+            pathnames.remove(media_file.pathname)
+    
     def change_metadata(self, media_files, imdb_id):
         # Find all title keys referenced by the scans
         title_keys = set()
@@ -220,63 +768,283 @@ class HomeTheaterDatabase(object):
             scans = StaticFileList(self.title_key_map[title_key])
             for item in scans:
                 log.debug("Changing metadata for %s" % item.pathname)
+                if item.metadata is not None:
+                    self.zodb.mark_changed("metadata", item.metadata.id)
                 item.metadata = metadata
                 metadata.update_with_media_files(scans)
+        self.index_metadata(metadata)
         self.zodb.commit()
     
-    def is_current(self, pathname, found_keys=None):
-        if pathname in self.scans:
+    def is_current(self, pathname, found_keys=None, stat_result=None):
+        media_file = self.scans.get(pathname, None)
+        if media_file is not None:
             if found_keys is not None:
                 found_keys.add(pathname)
-            media_file = self.scans[pathname]
-            return media_file.is_current()
+            return media_file.is_current(stat_result)
         return False
     
-    def scan_files(self, path_iterable, flags, found_keys=None):
-        """Scan files from an iterable object and add them to the database
+    def find_changed_files(self, entry_iterable, flags, found_keys=None):
+        """Generator returning (pathname, flags) tuples for the files that
+        need to be probed
+        
+        @param entry_iterable: iterable returning (pathname, stat_result)
+        tuples
+        """
+        for pathname, stat_result in entry_iterable:
+            if not self.is_current(pathname, found_keys, stat_result):
+                yield pathname, flags
+    
+    def iter_probe(self, pending):
+        """Generator to probe (pathname, flags) tuples, returning the results
+        of L{filescan.probe_worker} for each file as it completes.
+        
+        The probing is spread across a pool of worker processes if the
+        probe_processes setting allows more than one; the database itself is
+        only ever touched by the main process.
+        """
+        processes = settings.probe_processes
+        if processes == 0:
+            processes = multiprocessing.cpu_count()
+        pool = None
+        if processes > 1 and len(pending) > 1:
+            try:
+                pool = multiprocessing.Pool(min(processes, len(pending)))
+            except (OSError, ImportError), e:
+                log.error("Can't create probing pool, falling back to serial probing: %s" % e)
+        if pool is None:
+            for result in itertools.imap(probe_worker, pending):
+                yield result
+            return
+        log.info("Probing %d files using %d processes" % (len(pending), pool._processes))
+        try:
+            for result in pool.imap_unordered(probe_worker, pending, chunksize=4):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    
+    def scan_files(self, pending):
+        """Probe the (pathname, flags) tuples and add them to the database
+        
+        Files are committed in batches (controlled by the commit_batch_size
+        and commit_interval settings) so a large import doesn't have to hold
+        every new object in a single transaction.  No separate checkpoint is
+        needed to resume an interrupted scan: the files that have already
+        been committed pass the signature check in L{is_current}, so the
+        next scan only probes the rest.
+        """
+        committed = 0
+        batch_size = settings.commit_batch_size
+        interval = settings.commit_interval
+        batch = 0
+        last_commit = time.time()
+        for pathname, flags, probed, error in self.iter_probe(pending):
+            if probed is None:
+                log.error("Failed probing %s: %s" % (pathname, error))
+                continue
+            media_file = self.add(pathname, flags, probed)
+#            log.debug("added: %s" % self.get(media_file.pathname))
+            log.debug("added: %s" % media_file)
+            batch += 1
+            if (batch_size > 0 and batch >= batch_size) or (interval > 0 and time.time() - last_commit >= interval):
+                committed += batch
+                self.commit_scan_batch(committed)
+                batch = 0
+                last_commit = time.time()
+    
+    def commit_scan_batch(self, committed):
+        """Commit the files added so far
         """
-        for pathname in path_iterable:
-            if not self.is_current(pathname, found_keys=found_keys):
-                media_file = self.add(pathname, flags)
-#                log.debug("added: %s" % self.get(media_file.pathname))
-                log.debug("added: %s" % media_file)
+        log.info("Committing scan batch: %d files" % committed)
+        self.zodb.commit()
+        self.zodb.cache_gc()
         
     def scan_dirs(self, media_path_dict, valid_extensions=None):
         stored_keys = set(self.scans.keys())
         current_keys = set()
+        pending = []
         for path, flags in media_path_dict.iteritems():
             print "Parsing path %s" % path
-            dir_iterator = iter_dir(path, valid_extensions)
-            self.scan_files(dir_iterator, flags, current_keys)
+            dir_iterator = iter_dir_stat(path, valid_extensions, recurse="recurse" in flags)
+            pending.extend(self.find_changed_files(dir_iterator, flags, current_keys))
+        self.scan_files(pending)
         removed_keys = stored_keys - current_keys
         for key in removed_keys:
             print "Removing %s" % key
-            del self.scans[key]
+            self.remove(key)
         self.zodb.commit()
     
-    def update_metadata(self):
-        self.create_title_key_map()
-        self.update_metadata_map()
+    def find_media_root(self, pathname, media_path_dict):
+        """Return the (path, flags) tuple of the media path containing the
+        pathname, or (None, None) if it isn't in any of the media paths.
+        
+        Media paths can be nested, so the longest matching path is used.
+        """
+        found = (None, None)
+        for path, flags in media_path_dict.iteritems():
+            root = os.path.normpath(path)
+            if pathname == root or pathname.startswith(root + os.sep):
+                if found[0] is None or len(root) > len(found[0]):
+                    found = (root, flags)
+        return found
+    
+    def remove_path(self, pathname):
+        """Remove a media file, or if the pathname was a directory, all the
+        media files below it.
+        """
+        if pathname in self.scans:
+            self.remove(pathname)
+            return
+        prefix = pathname.rstrip(os.sep) + os.sep
+        for key in [k for k in self.scans.keys() if k.startswith(prefix)]:
+            self.remove(key)
+    
+    def iter_added_path(self, pathname, root, flags, valid_extensions=None):
+        """Generator returning (pathname, stat_result) tuples for the files
+        that would be found by scan_dirs at or below the pathname
+        """
+        recurse = "recurse" in flags
+        relative = os.path.relpath(pathname, root).split(os.sep)
+        if relative == [os.curdir]:
+            dirs = []
+        elif os.path.isdir(pathname):
+            dirs = relative
+        else:
+            dirs = relative[:-1]
+        if dirs and not recurse:
+            return
+        for dir in dirs:
+            if dir.endswith(".old"):
+                return
+        if os.path.isdir(pathname):
+            for entry in iter_dir_stat(pathname, valid_extensions, recurse=True):
+                yield entry
+            return
+        if valid_extensions and not pathname.endswith(tuple(valid_extensions)):
+            return
+        try:
+            yield pathname, os.stat(pathname)
+        except OSError:
+            pass
+    
+    def update_files(self, added, removed, media_path_dict, valid_extensions=None):
+        """Update the database using only the pathnames known to have
+        changed, rather than rescanning all the media paths.
+        
+        @param added: pathnames of files or directories that have been
+        created or modified
+        @param removed: pathnames of files or directories that have been
+        deleted
+        @returns: list of title keys that didn't have metadata before the
+        update
+        """
+        for pathname in removed:
+            self.remove_path(pathname)
+        pending = []
+        seen = set()
+        for pathname in added:
+            root, flags = self.find_media_root(os.path.normpath(pathname), media_path_dict)
+            if root is None:
+                continue
+            entries = self.iter_added_path(pathname, root, flags, valid_extensions)
+            for item in self.find_changed_files(entries, flags):
+                # A file may be reported on its own and as part of a new
+                # directory
+                if item[0] not in seen:
+                    seen.add(item[0])
+                    pending.append(item)
+        self.scan_files(pending)
+        
+        new_keys = [k for k in self.dirty_title_keys.keys() if k in self.title_key_map and k not in self.title_key_to_metadata]
+        self.update_metadata()
+        return new_keys
+    
+    def update_metadata(self, full=False):
+        """Look up metadata for title keys whose media files have changed
+        
+        @param full: if True, rebuild the title key map and look up metadata
+        for every title key in the database rather than only the dirty ones.
+        """
+        # The title key map is kept current by add and remove, so it only
+        # needs to be rebuilt when forced
+        if full:
+            self.create_title_key_map()
+        self.update_metadata_map(full)
         self.zodb.set_last_modified()
         self.zodb.commit()
     
-    def scan_and_update(self, media_path_dict, valid_extensions=None):
+    def scan_and_update(self, media_path_dict, valid_extensions=None, full=False):
         self.scan_dirs(media_path_dict, valid_extensions)
-        self.update_metadata()
+        self.update_metadata(full)
+    
+    def get_title_key_map_object(self):
+        t = self.zodb.get_value("title_key_btree", None)
+        if t is None:
+            t = TitleKeyMap()
+            self.zodb.set_value("title_key_btree", t)
+        return t
     
     def create_title_key_map(self):
-        t = self.zodb.get_mapping("title_key_map", clear=True)
+        t = self.get_title_key_map_object()
+        t.clear()
         for path, item in self.scans.iteritems():
             if item.scan and hasattr(item.scan, 'title_key'):
                 key = item.scan.title_key
-                if key not in t:
-                    t[key] = list()
-                t[key].append(item)
+                scans = t.get(key, None)
+                if scans is None:
+                    scans = PersistentList()
+                    t[key] = scans
+                scans.append(item)
         transaction.savepoint()
     
+    def index_title_key(self, media_file):
+        """Add a single media file to the title key map.
+        
+        Each title key holds a PersistentList, so adding a file to an existing
+        title only stores that list rather than the entire map.
+        """
+        item = media_file
+        if not (item.scan and hasattr(item.scan, 'title_key')):
+            return
+        key = item.scan.title_key
+        self.dirty_title_keys[key] = True
+        self.zodb.mark_changed("title_key", key)
+        t = self.get_title_key_map_object()
+        scans = t.get(key, None)
+        if scans is None:
+            t[key] = PersistentList([item])
+        else:
+            scans.append(item)
+    
+    def unindex_title_key(self, media_file):
+        """Remove a single media file from the title key map, removing the
+        title key itself if no other media files reference it.
+        """
+        item = media_file
+        if not (item.scan and hasattr(item.scan, 'title_key')):
+            return
+        key = item.scan.title_key
+        self.dirty_title_keys[key] = True
+        self.zodb.mark_changed("title_key", key)
+        if item.metadata is not None:
+            self.zodb.mark_changed("metadata", item.metadata.id)
+        t = self.get_title_key_map_object()
+        scans = t.get(key, None)
+        if scans is None:
+            return
+        # Compare by identity so the other media files aren't unghosted
+        remaining = [s for s in scans if s is not item]
+        if not remaining:
+            del t[key]
+        elif len(remaining) < len(scans):
+            scans[:] = remaining
+    
     def get_title_key_map(self):
-        t = self.zodb.get_mapping("title_key_map")
-        if not t:
+        t = self.get_title_key_map_object()
+        if not len(t):
             self.create_title_key_map()
             self.zodb.commit()
         return t
@@ -310,11 +1078,29 @@ class HomeTheaterDatabase(object):
             item.metadata = metadata
         metadata.update_with_media_files(scans)
         metadata.merge_database_objects(self)
+        self.index_metadata(metadata)
+        for item in scans:
+            self.index_play_date(item)
     
-    def update_metadata_map(self):
-        t = self.zodb.get_mapping("title_key_to_metadata")
-        for title_key, scans in self.iter_title_key_map():
+    def iter_dirty_title_key_map(self):
+        t = self.title_key_map
+        for title_key in self.dirty_title_keys.keys():
+            # Title keys of removed media files are also marked dirty, but
+            # there is nothing to look up if no media files remain
+            if title_key in t:
+                yield title_key, StaticFileList(t[title_key])
+    
+    def update_metadata_map(self, full=False):
+        if full:
+            title_key_iter = self.iter_title_key_map()
+        else:
+            title_key_iter = self.iter_dirty_title_key_map()
+        count = 0
+        for title_key, scans in title_key_iter:
             self.lookup_metadata(title_key, scans)
+            count += 1
+        log.debug("Looked up metadata for %d title keys" % count)
+        self.dirty_title_keys.clear()
             
         # Help for debugging a recursion error in zodb
         if False:
@@ -338,8 +1124,18 @@ class HomeTheaterDatabase(object):
         for key in valid_keys:
             yield key, t[key]
 
-    def update_posters(self):
-        for title_key, metadata in self.title_keys_with_metadata():
+    def update_posters(self, title_keys=None):
+        """Fetch posters for any title keys that are missing them
+        
+        @param title_keys: if specified, only check these title keys rather
+        than every title key in the database
+        """
+        if title_keys is None:
+            title_key_iter = self.title_keys_with_metadata()
+        else:
+            t = self.zodb.get_mapping("title_key_to_metadata")
+            title_key_iter = [(k, t[k]) for k in title_keys if k in t]
+        for title_key, metadata in title_key_iter:
             loader = MetadataLoader.get_loader(title_key)
             if loader.has_poster(metadata):
                 log.debug("Have poster for %s" % unicode(metadata).encode('utf-8'))
@@ -5,28 +5,84 @@ from persistent import Persistent
 
 import kaa.metadata
 
+
+def calc_signature(stat_result):
+    """Return the tuple used to determine if a file has changed since it was
+    last scanned
+    """
+    return (stat_result.st_mtime, stat_result.st_size, stat_result.st_ino)
+
+def probe(pathname, flags=""):
+    """Parse the media file and return a picklable summary of it.
+    
+    Only the parts of the kaa.metadata scan that will be stored in the
+    database are returned, as a dict created by the summarize classmethod of
+    the registered scan class.  This is run in the worker processes of the
+    probing pool, so it must not touch the database or use the logging
+    module.
+    
+    @returns: tuple of (signature, kaa media type, summary dict) where the
+    signature is None if the file doesn't exist
+    """
+    # Stat before parsing so a file that changes during the parse will be
+    # seen as out of date on the next scan
+    try:
+        signature = calc_signature(os.stat(pathname))
+    except OSError:
+        signature = None
+    
+    info = kaa.metadata.parse(pathname)
+    if info is None:
+        return signature, None, None
+    try:
+        baseclass = MediaFile.media_list[info.media]
+    except KeyError:
+        return signature, info.media, None
+    return signature, info.media, baseclass.summarize(pathname, flags, info)
+
+def probe_worker(args):
+    """Entry point for the probing process pool.
+    
+    Exceptions are returned as text rather than raised so that one bad file
+    doesn't abort the entire scan.
+    
+    @returns: tuple of (pathname, flags, probe results or None, error text)
+    """
+    pathname, flags = args
+    try:
+        return pathname, flags, probe(pathname, flags), None
+    except Exception, e:
+        return pathname, flags, None, str(e)
+
+
 class MediaFile(Persistent):
     media_list = {}
     
+    # Database versions prior to the addition of the signature only have the
+    # mtime available; they will be compared using only the mtime
+    signature = None
+    
     @classmethod
-    def guess(cls, media_file, info):
+    def guess(cls, media_file, media, summary):
         try:
-            baseclass = cls.media_list[info.media]
+            baseclass = cls.media_list[media]
         except KeyError:
             return None
-        return baseclass.guess(media_file, info)
+        if summary is None:
+            return None
+        return baseclass.guess(media_file, summary)
 
     @classmethod
     def register(cls, kaa_media_type, baseclass):
         cls.media_list[kaa_media_type] = baseclass
 
-    def __init__(self, pathname, flags=""):
+    def __init__(self, pathname, flags="", probed=None):
         self.pathname = pathname
         self.flags = flags
         self.mtime = -1
         self.scan = None
         self.metadata = None
-        self.reset()
+        self.reset(probed)
     
     def __str__(self):
         return "%s: %s" % (self.pathname, str(self.scan))
@@ -51,25 +107,36 @@ class MediaFile(Persistent):
             key = self.pathname
         return key
 
-    def reset(self):
+    def reset(self, probed=None):
+        """Create the scan object from the results of L{probe}, probing the
+        file first if the results aren't supplied.
+        """
         # Rather than saving a copy of the entire metadata scan, just save the
         # parts that we are going to use later.  This reduces database size by
         # almost an order of magnitude
-        info = kaa.metadata.parse(self.pathname)
-        
-        if os.path.exists(self.pathname):
-            self.mtime = os.stat(self.pathname).st_mtime
-        else:
+        if probed is None:
+            probed = probe(self.pathname, self.flags)
+        self.signature, media, summary = probed
+        if self.signature is None:
             self.mtime = -1
+        else:
+            self.mtime = self.signature[0]
         
-#        print info
-        if info is None:
+        if media is None:
             return
-        self.scan = self.__class__.guess(self, info)
+        self.scan = self.__class__.guess(self, media, summary)
     
-    def is_current(self):
-        if os.path.exists(self.pathname):
-            print self.pathname, os.stat(self.pathname).st_mtime, self.mtime
-            if os.stat(self.pathname).st_mtime == self.mtime:
-                return True
-        return False
+    def is_current(self, stat_result=None):
+        """Check if the file has changed since it was scanned
+        
+        @param stat_result: optional result of os.stat on the file if it is
+        already available, e.g.  from a directory scan
+        """
+        if stat_result is None:
+            try:
+                stat_result = os.stat(self.pathname)
+            except OSError:
+                return False
+        if self.signature is None:
+            return stat_result.st_mtime == self.mtime
+        return calc_signature(stat_result) == self.signature
@@ -11,51 +11,69 @@ class GameScanBase(Persistent):
     ignore_leading_articles = ["a", "an", "the"]
     
     @classmethod
-    def guess(cls, file, info):
-        if "basename" in file.flags:
-            name = os.path.basename(file.pathname)
-        else:
-            name = file.pathname
-        name = utils.decode_title_text(name)
-        if info.mime.startswith("games/atari-8bit"):
-            return Atari8bitScan(file, info)
-        elif info.mime.startswith("games/atari-st"):
-            return AtariSTScan(file, info)
-        return GameScanBase(file, info)
+    def summarize(cls, pathname, flags, info):
+        """Return a picklable dict of the parts of the kaa.metadata scan
+        needed to create the scan.
+        """
+        return {
+            'mime': info.mime,
+            }
+    
+    @classmethod
+    def guess(cls, file, summary):
+        mime = summary['mime']
+        if mime.startswith("games/atari-8bit"):
+            return Atari8bitScan(file, summary)
+        elif mime.startswith("games/atari-st"):
+            return AtariSTScan(file, summary)
+        return GameScanBase(file, summary)
     
-    def __init__(self, file, info):
+    def __init__(self, file, summary):
         self.play_date = None
         self.save_game = None
         self.position = 0
-        self.init_common(file, info)
-        self.title_key = self.calc_title_key(file, info)
+        self.init_common(file, summary)
+        self.title_key = self.calc_title_key(file, summary)
+        self.sort_key_cache = (self.title, self.calc_sort_key())
     
     def __str__(self):
         return "%s/%s" % (self.category, self.subcat)
     
+    # Tuple of (title, sort key), stored when the scan is created so the key
+    # doesn't have to be recalculated every time a menu is sorted.  Scans
+    # from older databases don't have it and use a volatile cache instead.
+    sort_key_cache = None
+    
     def sort_key(self):
+        """Return the cached sort key, recalculating it if the title has
+        changed since it was cached
+        """
+        cache = self.sort_key_cache
+        if cache is None or cache[0] != self.title:
+            cache = getattr(self, "_v_sort_key_cache", None)
+            if cache is None or cache[0] != self.title:
+                cache = (self.title, self.calc_sort_key())
+                self._v_sort_key_cache = cache
+        return cache[1]
+    
+    def calc_sort_key(self):
         """Return a 1-tuple:
         
         name
         """
-        t = self.title.lower()
-        for article in self.ignore_leading_articles:
-            a = "%s " % article.lower()
-            if t.startswith(a):
-                t = t[len(a):] + ", %s" % t[0:len(article)]
-                break
+        t = utils.sort_title(self.title, self.ignore_leading_articles)
         return (t,)
     
-    def init_common(self, file, info):
-        self.title = self.calc_title(file, info)
+    def init_common(self, file, summary):
+        self.title = self.calc_title(file, summary)
     
-    def calc_title_key(self, file, info):
+    def calc_title_key(self, file, summary):
         return utils.TitleKey(self.category, self.subcat, self.title, None)
     
-    def calc_title(self, file, info):
+    def calc_title(self, file, summary):
         return os.path.basename(file.pathname)
     
-    def set_last_position(self, data):
+    def set_last_position(self, data, before_commit=None):
         pass
     
     def has_saved_games(self):
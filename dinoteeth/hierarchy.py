@@ -1,32 +1,58 @@
-import os, sys, glob, re, logging, time, calendar
+import os, sys, glob, re, logging, time, calendar, collections
 
 from model import MenuItem, MenuPopulator
 import settings
 from photo import TopLevelPhoto
 from metadata import MetadataLoader, BaseMetadata
-from utils import TitleKey
-from database import StaticFileList
+from utils import TitleKey, DBFacade
+from database import StaticFileList, FilteredFileList, TitleSearchIndex
 
 log = logging.getLogger("dinoteeth.hierarchy")
 
 
 class MMDBPopulator(MenuPopulator):
-    def __init__(self, config):
-        MenuPopulator.__init__(self, config)
-        self.cached_media = None
+    # LRU cache of media lists shared by all populators: populator ->
+    # (database generation, media).  Entries are stale once the generation
+    # changes, i.e.  after a commit or after a sync picks up changes from
+    # the update monitor.
+    media_cache = collections.OrderedDict()
+    media_cache_size = 64
     
     def get_media(self):
         return StaticFileList()
     
     def get_cached_media(self):
-        if self.cached_media is None or True:
-#        if self.cached_media is None:
+        cache = MMDBPopulator.media_cache
+        generation = DBFacade.generation
+        entry = cache.pop(self, None)
+        if entry is None or entry[0] != generation:
             log.debug("start: getting media for %s" % self.__class__.__name__)
-            self.cached_media = self.get_media()
+            media = self.get_media()
+            
+            # Filtered lists are evaluated every time they are iterated, so
+            # store the results rather than the filter chain
+            if isinstance(media, FilteredFileList):
+                media = media.static_list()
+            entry = (generation, media)
             log.debug("finish: getting media for %s" % self.__class__.__name__)
-        return self.cached_media
+        cache[self] = entry
+        while len(cache) > self.media_cache_size:
+            cache.popitem(last=False)
+        return entry[1]
     
     media = property(get_cached_media)
+    
+    def invalidate_media(self):
+        MMDBPopulator.media_cache.pop(self, None)
+    
+    # Changes recorded by HomeTheaterDatabase when media files are added,
+    # removed or assigned different metadata
+    media_changes = set(["title_key", "metadata"])
+    
+    def depends_on_change(self, attr, id):
+        # Any change to the set of media files may change a database menu;
+        # other attributes only affect the menus that declare them
+        return attr in self.media_changes
         
     def get_search_populator(self, text):
         return SearchPopulator(self, self.config, text)
@@ -52,17 +78,26 @@ class MMDBPopulator(MenuPopulator):
 class MetadataLookup(MMDBPopulator):
     heading_indent = u"      "
     
-    def __init__(self, parent, config, filter=None, metadata_filter=None, metadata_filter_accept=None):
+    lazy_children = True
+    
+    def __init__(self, parent, config, filter=None, metadata_filter=None, metadata_filter_accept=None, depends_on=None):
+        """
+        @param depends_on: list of attributes (as used in
+        L{DBFacade.mark_changed}) that the filters depend on.  A change to
+        one of these attributes of any metadata causes the menu to be
+        repopulated.
+        """
         MMDBPopulator.__init__(self, config)
         self.parent = parent
         self.filter = filter
+        self.depends_on = set(depends_on or [])
         self.metadata_filter = metadata_filter
         if metadata_filter_accept is None:
             metadata_filter_accept = lambda v: v == 0
         self.metadata_filter_accept = metadata_filter_accept
     
     def get_media(self):
-        media = self.parent.get_media().filter(self.filter)
+        media = self.parent.media.filter(self.filter)
         if self.metadata_filter:
             unique, scans_in_each = media.get_unique_metadata_with_value(self.metadata_filter)
             media = StaticFileList()
@@ -70,6 +105,16 @@ class MetadataLookup(MMDBPopulator):
                 if self.metadata_filter_accept(value):
                     media.extend(scans_in_each[metadata])
         return media
+    
+    def depends_on_change(self, attr, id):
+        if attr in self.depends_on:
+            return True
+        
+        # The media is a subset of the parent's media, so anything that
+        # changes the parent's media may change this menu, too
+        if isinstance(self.parent, MetadataLookup):
+            return self.parent.depends_on_change(attr, id)
+        return MMDBPopulator.depends_on_change(self, attr, id)
         
     def iter_create(self):
         metadata = self.get_sorted_metadata()
@@ -77,6 +122,17 @@ class MetadataLookup(MMDBPopulator):
             data = self.get_menu_data(m)
             yield data
     
+    def iter_create_lazy(self):
+        metadata = self.get_sorted_metadata()
+        for m in metadata:
+            yield self.get_lazy_menu_data(m)
+    
+    def get_lazy_menu_data(self, m):
+        """Same as get_menu_data, except the populator is only created when
+        the returned factory is called
+        """
+        return unicode(m.title), lambda: self.get_menu_data(m)[1]
+    
     def get_menu_data(self, m):
         if m.media_category == "video":
             if m.media_subcategory == "series":
@@ -98,13 +154,46 @@ class MetadataLookup(MMDBPopulator):
 class SearchPopulator(MetadataLookup):
     def __init__(self, parent, config, initial_text=""):
         MetadataLookup.__init__(self, parent, config)
+        self.search_text = None
+        self.search_ids = None
+        self.search_index = None
+        self.group_cache = None
         self.set_search_text(initial_text)
         
     def set_search_text(self, text):
         self.root_title = "Search: %s_" % text
-        text = text.lower()
+        text = TitleSearchIndex.normalize(text)
 #        print "search text: -->%s<--" % text
-        self.filter = lambda f: text in f.metadata.title.lower()
+        index = self.config.db.get_title_search_index()
+        if self.search_ids is not None and self.search_index is index and self.search_text in text:
+            # Adding characters can only narrow the previous results
+            ids = index.search(text, self.search_ids)
+        else:
+            ids = index.search(text)
+        self.search_text = text
+        self.search_ids = ids
+        self.search_index = index
+        self.filter = lambda f: f.metadata is not None and f.metadata.id in ids
+        self.invalidate_media()
+    
+    def get_scans_by_id(self):
+        generation = DBFacade.generation
+        if self.group_cache is None or self.group_cache[0] != generation:
+            unique, scans_in_each = self.parent.media.get_unique_metadata()
+            scans_by_id = {}
+            for metadata, scans in scans_in_each.iteritems():
+                if metadata is not None:
+                    scans_by_id[metadata.id] = scans
+            self.group_cache = (generation, scans_by_id)
+        return self.group_cache[1]
+    
+    def get_media(self):
+        scans_by_id = self.get_scans_by_id()
+        media = StaticFileList()
+        for id in self.search_ids:
+            if id in scans_by_id:
+                media.extend(scans_by_id[id])
+        return media
 
 
 def only_paused(item):
@@ -120,13 +209,18 @@ def play_date(item):
 
 
 class TopLevelLookup(MetadataLookup):
+    lazy_children = False
+    
+    # Maximum number of entries in the "Recently ..." menus
+    recent_limit = 100
+    
     def iter_create(self):
         yield "All", MetadataLookup(self, self.config)
-        yield "Favorites", MetadataLookup(self, self.config, filter=lambda f: f.metadata.starred)
-        yield "Paused", ExpandedLookup(self, self.config, filter=only_paused, time_lookup=play_date)
-        yield "Recently Added", DateLookup(self, self.config)
-        yield "Recently Played", DateLookup(self, self.config, filter=lambda f: f.scan.play_date is not None, time_lookup=play_date)
-        yield "Never Played", MetadataLookup(self, self.config, metadata_filter=play_date)
+        yield "Favorites", MetadataLookup(self, self.config, filter=lambda f: f.metadata.starred, depends_on=["starred"])
+        yield "Paused", ExpandedLookup(self, self.config, filter=only_paused, time_lookup=play_date, depends_on=["play"])
+        yield "Recently Added", DateLookup(self, self.config, index="date_added", limit=self.recent_limit)
+        yield "Recently Played", DateLookup(self, self.config, filter=lambda f: f.scan.play_date is not None, time_lookup=play_date, index="play_date", limit=self.recent_limit, depends_on=["play"])
+        yield "Never Played", MetadataLookup(self, self.config, metadata_filter=play_date, depends_on=["play"])
         yield "In HD", MetadataLookup(self, self.config, filter=lambda f: (hasattr(f.scan, 'video') and f.scan.video and f.scan.video[0]['width'] > 900))
         
         for title, credit_entry in self.iter_credit():
@@ -158,18 +252,45 @@ class TopLevelGames(TopLevelLookup):
 
 
 class DateLookup(MetadataLookup):
-    def __init__(self, parent, config, filter=None, time_lookup=None):
-        MetadataLookup.__init__(self, parent, config, filter)
+    def __init__(self, parent, config, filter=None, time_lookup=None, index=None, limit=None, depends_on=None):
+        """Menu of metadata sorted from newest to oldest
+        
+        @param index: name of the database's L{DateIndex} to use; otherwise
+        the dates are calculated from the media using time_lookup
+        @param limit: maximum number of entries to show
+        """
+        MetadataLookup.__init__(self, parent, config, filter, depends_on=depends_on)
         if time_lookup is None:
             time_lookup = lambda f: f.metadata.date_added
         self.time_lookup = time_lookup
+        self.index = index
+        self.limit = limit
     
     def get_sorted_metadata_with_date(self):
+        if self.index is not None:
+            return self.get_indexed_metadata_with_date()
         unique, scans_in_each = self.media.get_unique_metadata_with_value(self.time_lookup)
         order = sorted([(v, m) for m, v in unique.iteritems()])
         metadata_with_date = [(item[1], item[0]) for item in reversed(order)]
+        if self.limit is not None:
+            metadata_with_date = metadata_with_date[:self.limit]
         return metadata_with_date
     
+    def get_indexed_metadata_with_date(self, since=None):
+        unique, scans_in_each = self.media.get_unique_metadata()
+        by_id = dict((m.id, m) for m in unique if m is not None)
+        date_index = self.config.db.get_date_index(self.index)
+        metadata_with_date = []
+        for id, timestamp in date_index.iter_newest(since):
+            if id in by_id:
+                metadata_with_date.append((by_id[id], timestamp))
+                if self.limit is not None and len(metadata_with_date) >= self.limit:
+                    break
+        return metadata_with_date
+    
+    def get_sorted_metadata(self):
+        return [m for m, m_time in self.get_sorted_metadata_with_date()]
+    
     labels = [
         ("This Week", 7*24*3600),
         ("Last Week", 14*24*3600),
@@ -182,12 +303,18 @@ class DateLookup(MetadataLookup):
         ]
     
     def iter_create(self):
+        return self.iter_labeled(self.get_menu_data)
+    
+    def iter_create_lazy(self):
+        return self.iter_labeled(self.get_lazy_menu_data)
+    
+    def iter_labeled(self, get_data):
         metadata = self.get_sorted_metadata_with_date()
         label_index = 0
         label_needed = True
         start_time = time.time()
         for m, m_time in metadata:
-            data = self.get_menu_data(m)
+            data = get_data(m)
             while m_time < start_time - self.labels[label_index][1]:
                 label_index += 1
                 label_needed = True
@@ -197,27 +324,39 @@ class DateLookup(MetadataLookup):
             yield data
 
 
-class IndexedDateLookup(MetadataLookup):
-    def __init__(self, parent, config, filter=None, time_lookup=None):
-        MetadataLookup.__init__(self, parent, config, filter)
-        if time_lookup is None:
-            time_lookup = lambda f: f.metadata.date_added
-        self.time_lookup = time_lookup
+class IndexedDateLookup(DateLookup):
+    lazy_children = False
     
-    def get_sorted_metadata(self):
-        unique, scans_in_each = self.media.get_unique_metadata_with_value(self.time_lookup)
-        order = sorted([(v, m) for m, v in unique.iteritems()])
-        metadata = [item[1] for item in reversed(order)]
-        return metadata
+    def __init__(self, parent, config, filter=None, time_lookup=None, index="date_added"):
+        DateLookup.__init__(self, parent, config, filter, time_lookup, index)
+    
+    ranges = [
+        ("Last Week", 7*24*3600),
+        ("Last 2 Weeks", 14*24*3600),
+        ("Last Month", 31*24*3600),
+        ("Last 2 Months", 62*24*3600),
+        ("Last 3 Months", 93*24*3600),
+        ("Last 6 Months", 182*24*3600),
+        ("Last Year", 365*24*3600),
+        ]
         
     def iter_create(self):
-        yield "Last Week", MetadataLookup(self, self.config, filter=lambda item: self.time_lookup(item) >= time.time() - 7*24*3600)
-        yield "Last 2 Weeks", MetadataLookup(self, self.config, filter=lambda item: self.time_lookup(item) >= time.time() - 14*24*3600)
-        yield "Last Month", MetadataLookup(self, self.config, filter=lambda item: self.time_lookup(item) >= time.time() - 31*24*3600)
-        yield "Last 2 Months", MetadataLookup(self, self.config, filter=lambda item: self.time_lookup(item) >= time.time() - 62*24*3600)
-        yield "Last 3 Months", MetadataLookup(self, self.config, filter=lambda item: self.time_lookup(item) >= time.time() - 93*24*3600)
-        yield "Last 6 Months", MetadataLookup(self, self.config, filter=lambda item: self.time_lookup(item) >= time.time() - 182*24*3600)
-        yield "Last Year", MetadataLookup(self, self.config, filter=lambda item: self.time_lookup(item) >= 365*24*3600)
+        for title, age in self.ranges:
+            yield title, DateRangeLookup(self, self.config, age)
+
+
+class DateRangeLookup(MetadataLookup):
+    """Metadata newer than a given age, as determined by the parent's date
+    index
+    """
+    def __init__(self, parent, config, age):
+        MetadataLookup.__init__(self, parent, config)
+        self.age = age
+    
+    def get_media(self):
+        since = time.time() - self.age
+        ids = set(m.id for m, m_time in self.parent.get_indexed_metadata_with_date(since))
+        return self.parent.media.filter(lambda f: f.metadata is not None and f.metadata.id in ids)
 
 
 class CreditLookup(MetadataLookup):
@@ -228,40 +367,80 @@ class CreditLookup(MetadataLookup):
             converter = lambda d: d
         self.converter = converter
         self.reverse_sort = reverse_sort
+        self.group_cache = None
     
-    def iter_create(self):
-        results = {}
-        unique, scans_in_earch = self.media.get_unique_metadata()
-        for metadata in unique:
-            if metadata.match(self.credit):
-                for credit_value in metadata.iter_items_of(self.credit):
-                    results[self.converter(credit_value)] = credit_value
-        presorted = zip(results.values(), results.keys())
+    def get_groups(self):
+        """Group the media by the converted values of the credit using the
+        credit index of the database.
+        
+        @returns: tuple of dicts: (converted value -> [representative credit
+        value, set of metadata ids]) and (metadata id -> list of media files)
+        """
+        generation = DBFacade.generation
+        if self.group_cache is None or self.group_cache[0] != generation:
+            db = self.config.db
+            index = db.get_credit_index(self.credit)
+            unique, scans_in_each = self.media.get_unique_metadata()
+            groups = {}
+            scans_by_id = {}
+            values = {}
+            for metadata in unique:
+                if metadata is None:
+                    continue
+                scans_by_id[metadata.id] = scans_in_each[metadata]
+                for key in index.get_value_keys(metadata.id):
+                    if key not in values:
+                        values[key] = index.get_value(db, key)
+                    value = values[key]
+                    if value is None:
+                        continue
+                    converted = self.converter(value)
+                    if converted not in groups:
+                        groups[converted] = [value, set()]
+                    groups[converted][1].add(metadata.id)
+            self.group_cache = (generation, groups, scans_by_id)
+        return self.group_cache[1], self.group_cache[2]
+    
+    def get_media_of(self, converted):
+        groups, scans_by_id = self.get_groups()
+        media = StaticFileList()
+        if converted in groups:
+            for id in groups[converted][1]:
+                media.extend(scans_by_id[id])
+        return media
+    
+    def get_sorted_values(self):
+        groups, scans_by_id = self.get_groups()
+        presorted = [(value, converted) for converted, (value, ids) in groups.iteritems()]
         presorted.sort()
-        credits = [i[1] for i in presorted]
         if self.reverse_sort:
-            credits.reverse()
-        for credit in credits:
-            if hasattr(credit, 'imdb_prefix'):
-                name = unicode(credit)
-            else:
-                name = credit
-            name = unicode(credit)
-            
-            # Have to rebind `credit` to a default argument rather than
-            # simply
-            #
-            # lambda f: f.metadata.match(self.credit, credit,
-            # self.converter)
-            #
-            # because the for loop rebinds the local variable during each
-            # iteration and when the lambda function is eventually called
-            # (well after this loop completes) all the lambdas point to the
-            # last value when looking up `credit`
-            yield name, MetadataLookup(self, self.config, filter=lambda item, value=credit: item.metadata.match(self.credit, value, self.converter))
+            presorted.reverse()
+        return [converted for value, converted in presorted]
+    
+    def iter_create(self):
+        for converted in self.get_sorted_values():
+            yield unicode(converted), CreditValueLookup(self, self.config, converted)
+    
+    def iter_create_lazy(self):
+        for converted in self.get_sorted_values():
+            yield unicode(converted), lambda c=converted: CreditValueLookup(self, self.config, c)
+
+
+class CreditValueLookup(MetadataLookup):
+    """Media having a single value of the parent's credit, taken directly from
+    the parent's grouping rather than matching each media file
+    """
+    def __init__(self, parent, config, converted):
+        MetadataLookup.__init__(self, parent, config)
+        self.converted = converted
+    
+    def get_media(self):
+        return self.parent.get_media_of(self.converted)
 
 
 class PlayableEntries(MetadataLookup):
+    lazy_children = False
+    
     def __init__(self, parent, config, metadata):
         self.metadata = metadata
         MetadataLookup.__init__(self, parent, config, filter=lambda f: f.metadata.id == self.metadata.id)
@@ -276,6 +455,11 @@ class PlayableEntries(MetadataLookup):
             item = MenuItem(title, action=playable.play, metadata=playable.get_metadata())
             yield item
     
+    def depends_on_change(self, attr, id):
+        # Only this title's media files are listed, and the resume entries
+        # depend on their play position
+        return attr in ("play", "metadata") and id == self.metadata.id
+    
     def get_resume_entry(self, media_file, season=None):
         return "  Resume (Paused at %s)" % media_file.scan.paused_at_text(), MediaPlay(self.config, self.metadata, media_file, season=season, resume=True)
 
@@ -305,6 +489,8 @@ class MovieTopLevel(PlayableEntries):
 
 
 class SeriesTopLevel(MetadataLookup):
+    lazy_children = False
+    
     def __init__(self, parent, config, metadata):
         self.metadata = metadata
         MetadataLookup.__init__(self, parent, config, filter=lambda f: f.metadata.id == self.metadata.id)
@@ -392,7 +578,7 @@ class MediaPlay(MMDBPopulator):
         else:
             resume_at = 0.0
         last_pos = client.play(self.media_file, resume_at=resume_at, resume_data=self.resume_data)
-        self.media_file.scan.set_last_position(last_pos)
+        self.config.db.set_last_position(self.media_file, last_pos)
         self.config.restore_after_external_app()
     
     def get_metadata(self):
@@ -400,6 +586,7 @@ class MediaPlay(MMDBPopulator):
             'mmdb': self.metadata,
             'media_file': self.media_file,
             'season': self.season,
+            'db': self.config.db,
             }
 
 class MediaPlayMultiple(MMDBPopulator):
@@ -419,7 +606,7 @@ class MediaPlayMultiple(MMDBPopulator):
             else:
                 resume_at = 0.0
             last_pos = client.play(f)
-            f.scan.set_last_position(last_pos)
+            self.config.db.set_last_position(f, last_pos)
             if not f.scan.is_considered_complete(last_pos):
                 # Stop the playlist if the user quits in the middle of playback
                 break
@@ -433,8 +620,10 @@ class MediaPlayMultiple(MMDBPopulator):
 
 
 class ExpandedLookup(MetadataLookup):
-    def __init__(self, parent, config, filter=None, time_lookup=None):
-        MetadataLookup.__init__(self, parent, config, filter)
+    lazy_children = False
+    
+    def __init__(self, parent, config, filter=None, time_lookup=None, depends_on=None):
+        MetadataLookup.__init__(self, parent, config, filter, depends_on=depends_on)
         if time_lookup is None:
             time_lookup = lambda f: f.metadata.date_added
         self.time_lookup = time_lookup
@@ -473,6 +662,8 @@ class ExpandedLookup(MetadataLookup):
 
 
 class ChangeImdbRoot(MetadataLookup):
+    lazy_children = False
+    
     def __init__(self, parent, config, metadata):
         MetadataLookup.__init__(self, parent, config, filter=lambda f: f.metadata.id == metadata.id)
         self.metadata = metadata
@@ -511,6 +702,7 @@ class ChangeImdb(MMDBPopulator):
         status = "Selected %s" % self.result['smart long imdb canonical title'].encode('utf-8')
         metadata = self.loader.get_metadata_by_id(self.result.imdb_id, self.title_key.subcategory)
         metadata.merge_database_objects(self.config.db)
+        self.config.db.zodb.mark_changed("metadata", metadata.id)
         self.config.db.zodb.commit()
         media_files = self.parent.get_media()
         self.config.db.change_metadata(media_files, metadata.id)
@@ -524,6 +716,8 @@ class ChangeImdb(MMDBPopulator):
 
 
 class ChangePosterRoot(MetadataLookup):
+    lazy_children = False
+    
     def __init__(self, parent, config, metadata, season=None):
         MetadataLookup.__init__(self, parent, config, filter=lambda f: f.metadata.id == metadata.id)
         self.metadata = metadata
@@ -598,8 +792,8 @@ class RootPopulator(MMDBPopulator):
         return self.config.db.get_all("all")
 
     def iter_create(self):
-        yield "Favorites", MetadataLookup(self, self.config, filter=lambda f: f.metadata and f.metadata.starred)
-        yield "Paused", ExpandedLookup(self, self.config, filter=only_paused, time_lookup=play_date)
+        yield "Favorites", MetadataLookup(self, self.config, filter=lambda f: f.metadata and f.metadata.starred, depends_on=["starred"])
+        yield "Paused", ExpandedLookup(self, self.config, filter=only_paused, time_lookup=play_date, depends_on=["play"])
         yield "Movies & Series", TopLevelVideos(self, self.config)
         yield "Just Movies", TopLevelVideos(self, self.config, lambda f: f.scan.subcat == "movie")
         yield "Just Series", TopLevelVideos(self, self.config, lambda f: f.scan.subcat == "series")
@@ -620,7 +814,7 @@ class TestMenuSearch(MetadataLookup):
 class TestMenu(MetadataLookup):
     def __init__(self, config):
         parent = RootPopulator(config)
-        MetadataLookup.__init__(self, parent, config, metadata_filter=play_date)
+        MetadataLookup.__init__(self, parent, config, metadata_filter=play_date, depends_on=["play"])
         self.root_title = "Never Played"
 
 def RootMenu(config):
@@ -16,30 +16,93 @@ class AVScanBase(Persistent):
     percent_considered_complete = 0.96
     
     @classmethod
-    def guess(cls, file, info):
-        if "basename" in file.flags:
-            name = os.path.basename(file.pathname)
+    def summarize(cls, pathname, flags, info):
+        """Return a picklable dict of the parts of the kaa.metadata scan that
+        are stored in the scan, plus the guessit results from the filename.
+        """
+        # Rather than saving a copy of the entire metadata scan, just save the
+        # parts that we are going to use later.  This reduces database size by
+        # an order of magnitude
+        video = []
+        for i, v in enumerate(info.video):
+            video.append({
+                'codec': v.codec,
+                'fourcc': v.fourcc,
+                'width': v.width,
+                'height': v.height,
+                'id': v.id,
+                })
+        
+        audio = []
+        for i, a in enumerate(info.audio):
+            title = a.title
+            if not title:
+                channels = a.channels
+                if not channels:
+                    title = "Audio Track %d" % (i + 1)
+                else:
+                    if a.channels == 1:
+                        title = "Mono"
+                    elif a.channels == 2:
+                        title = "Stereo"
+                    else:
+                        title = "%d Channels" % a.channels
+            audio.append({
+                'title': title,
+                'channels': a.channels,
+                'codec': a.codec,
+                'id': a.id,
+                })
+        
+        subtitles = []
+        for s in info.subtitles:
+            subtitles.append({
+                'title': s.title,
+                'codec': s.codec,
+                'id': s.id,
+                })
+        
+        return {
+            'video': video,
+            'audio': audio,
+            'subtitles': subtitles,
+            'length': info.length,
+            'guess': cls.calc_guess(pathname, flags),
+            }
+    
+    @classmethod
+    def calc_guess(cls, pathname, flags):
+        if "basename" in flags:
+            name = os.path.basename(pathname)
         else:
-            name = file.pathname
+            name = pathname
         name = utils.decode_title_text(name)
-        if "series" in file.flags or "episode" in file.flags:
+        if "series" in flags or "episode" in flags:
             subcat = "episode"
-        elif "movie" in file.flags:
+        elif "movie" in flags:
             subcat = "movie"
         else:
             subcat = "autodetect"
         guess = guess_file_info(name, subcat)
+        
+        # Store as a plain dict so it can be pickled by the probing pool
+        return dict(guess)
+    
+    @classmethod
+    def guess(cls, file, summary):
+        guess = summary['guess']
         if guess['type'] == "episode":
-            return SeriesScan(file, info, guess)
-        return MovieScan(file, info, guess)
+            return SeriesScan(file, summary, guess)
+        return MovieScan(file, summary, guess)
         
-    def __init__(self, file, info, guess):
+    def __init__(self, file, summary, guess):
         self.play_date = None
         self.position = 0
-        self.init_common(file, info, guess)
-        self.init_attributes(file, info, guess)
-        self.display_title = self.calc_display_title(file, info, guess)
-        self.title_key = self.calc_title_key(file, info, guess)
+        self.init_common(file, summary, guess)
+        self.init_attributes(file, summary, guess)
+        self.display_title = self.calc_display_title(file, summary, guess)
+        self.title_key = self.calc_title_key(file, summary, guess)
+        self.sort_key_cache = (self.title, self.calc_sort_key())
     
     def __str__(self):
         try:
@@ -48,7 +111,24 @@ class AVScanBase(Persistent):
         except:
             return "%s/%s %d audio, %d subtitles, length=%s" % (self.category, self.subcat, len(self.audio), len(self.subtitles), self.length)
     
+    # Tuple of (title, sort key), stored when the scan is created so the key
+    # doesn't have to be recalculated every time a menu is sorted.  Scans
+    # from older databases don't have it and use a volatile cache instead.
+    sort_key_cache = None
+    
     def sort_key(self):
+        """Return the cached sort key, recalculating it if the title has
+        changed since it was cached
+        """
+        cache = self.sort_key_cache
+        if cache is None or cache[0] != self.title:
+            cache = getattr(self, "_v_sort_key_cache", None)
+            if cache is None or cache[0] != self.title:
+                cache = (self.title, self.calc_sort_key())
+                self._v_sort_key_cache = cache
+        return cache[1]
+    
+    def calc_sort_key(self):
         """Return a 5-tuple:
         
         name
@@ -65,18 +145,18 @@ class AVScanBase(Persistent):
         self.selected_audio_id = old_scan.selected_audio_id
         self.selected_subtitle_id = old_scan.selected_subtitle_id
     
-    def init_attributes(self, file, info, guess):
+    def init_attributes(self, file, summary, guess):
         pass
     
-    def init_bonus(self, file, info, guess):
+    def init_bonus(self, file, summary, guess):
         if 'bonusNumber' in guess or 'bonusTitle' in guess:
             self.is_bonus = True
         else:
             self.is_bonus = False
-        self.bonus_title = self.calc_bonus_title(file, info, guess)
+        self.bonus_title = self.calc_bonus_title(file, summary, guess)
         self.bonus_number = guess.get('bonusNumber', 0)
     
-    def calc_bonus_title(self, file, info, guess):
+    def calc_bonus_title(self, file, summary, guess):
         bonus = None
         g = guess
         if 'bonusNumber' in g:
@@ -88,7 +168,7 @@ class AVScanBase(Persistent):
             bonus = str(g['bonusTitle'])
         return bonus
     
-    def calc_title_key(self, file, info, guess):
+    def calc_title_key(self, file, summary, guess):
         try:
             year = guess['year']
         except KeyError:
@@ -96,56 +176,17 @@ class AVScanBase(Persistent):
         #return TitleKey(self.category, self.subcat, self.title, year)
         return utils.TitleKey(self.category, self.subcat, self.title, None)
     
-    def init_common(self, file, info, guess):
-        # Rather than saving a copy of the entire metadata scan, just save the
-        # parts that we are going to use later.  This reduces database size by
-        # an order of magnitude
-        self.video = []
-        for i, v in enumerate(info.video):
-            self.video.append({
-                'codec': v.codec,
-                'fourcc': v.fourcc,
-                'width': v.width,
-                'height': v.height,
-                'id': v.id,
-                })
-        
-        self.audio = []
-        for i, a in enumerate(info.audio):
-            title = a.title
-            if not title:
-                channels = a.channels
-                if not channels:
-                    title = "Audio Track %d" % (i + 1)
-                else:
-                    if a.channels == 1:
-                        title = "Mono"
-                    elif a.channels == 2:
-                        title = "Stereo"
-                    else:
-                        title = "%d Channels" % a.channels
-            self.audio.append({
-                'title': title,
-                'channels': a.channels,
-                'codec': a.codec,
-                'id': a.id,
-                })
-        
-        self.subtitles = []
-        for s in info.subtitles:
-            self.subtitles.append({
-                'title': s.title,
-                'codec': s.codec,
-                'id': s.id,
-                })
-        
-        self.length = info.length
+    def init_common(self, file, summary, guess):
+        self.video = summary['video']
+        self.audio = summary['audio']
+        self.subtitles = summary['subtitles']
+        self.length = summary['length']
         
         self.selected_audio_id = 0
         self.selected_subtitle_id = None
         
-        self.title = self.calc_title(file, info, guess)
-        self.init_bonus(file, info, guess)
+        self.title = self.calc_title(file, summary, guess)
+        self.init_bonus(file, summary, guess)
     
     def iter_audio(self):
         for a in self.audio:
@@ -244,24 +285,39 @@ class AVScanBase(Persistent):
     def is_considered_complete(self, last_pos):
         return last_pos >= self.percent_considered_complete * self.length
 
-    def set_last_position(self, last_pos=-1.0):
+    def set_last_position(self, last_pos=-1.0, before_commit=None):
+        """Save the playback position and play date
+        
+        Only write conflicts with another client (e.g.  the update monitor)
+        are retried; aborting discards the conflicting changes so each retry
+        starts from the other client's committed state.  Any other error is
+        passed on to the caller.
+        
+        @param before_commit: optional callable to be called before each
+        attempt to commit, e.g.  to update indexes in the same transaction
+        """
         if self.is_considered_complete(last_pos):
             last_pos = -1.0
         retry = 3
-        while retry > 0:
+        while True:
             self.play_date = datetime.utcnow()
             self.position = last_pos
+            if before_commit is not None:
+                before_commit()
             try:
                 utils.DBFacade.commit()
                 print "Updated position"
                 return
-            except:
+            except utils.DBFacade.conflict:
                 utils.DBFacade.abort()
             
+            retry -= 1
+            if retry <= 0:
+                print "Conflict saving position; giving up"
+                return
             import time
             print "Retrying..."
             time.sleep(.2)
-            retry -= 1
 
     def get_last_position(self):
         return self.position
@@ -285,15 +341,15 @@ class AVScanBase(Persistent):
 class MovieScan(AVScanBase):
     subcat = "movie"
 
-    def calc_title(self, file, info, guess):
+    def calc_title(self, file, summary, guess):
         if 'title' in guess:
             return guess['title']
         return os.path.basename(file.pathname)
     
-    def init_attributes(self, file, info, guess):
-        self.film_number = self.calc_film_number(file, info, guess)
+    def init_attributes(self, file, summary, guess):
+        self.film_number = self.calc_film_number(file, summary, guess)
         
-    def sort_key(self):
+    def calc_sort_key(self):
         """Return a 5-tuple:
         
         season
@@ -302,19 +358,14 @@ class MovieScan(AVScanBase):
         name
         bonus title
         """
-        t = self.title.lower()
-        for article in self.ignore_leading_articles:
-            a = "%s " % article.lower()
-            if t.startswith(a):
-                t = t[len(a):] + ", %s" % t[0:len(article)]
-                break
+        t = utils.sort_title(self.title, self.ignore_leading_articles)
         key = (0, self.bonus_number, 0, t, self.bonus_title)
         return key
 
-    def calc_film_number(self, file, info, guess):
+    def calc_film_number(self, file, summary, guess):
         return guess.get('filmNumber', 1)
     
-    def calc_display_title(self, file, info, guess):
+    def calc_display_title(self, file, summary, guess):
         if self.is_bonus:
             title = self.bonus_title
         else:
@@ -326,7 +377,7 @@ class MovieScan(AVScanBase):
 class SeriesScan(AVScanBase):
     subcat = "series"
         
-    def sort_key(self):
+    def calc_sort_key(self):
         """Return a 5-tuple:
         
         season
@@ -335,31 +386,26 @@ class SeriesScan(AVScanBase):
         name
         bonus title
         """
-        t = self.title.lower()
-        for article in self.ignore_leading_articles:
-            a = "%s " % article.lower()
-            if t.startswith(a):
-                t = t[len(a):] + ", %s" % t[0:len(article)]
-                break
+        t = utils.sort_title(self.title, self.ignore_leading_articles)
         return (self.season, self.bonus_number, self.episode, t, self.bonus_title)
 
-    def calc_title(self, file, info, guess):
+    def calc_title(self, file, summary, guess):
         if 'series' in guess:
             return guess['series']
         return os.path.basename(file.pathname)
     
-    def init_attributes(self, file, info, guess):
-        self.season = self.calc_season(file, info, guess)
-        self.episode = self.calc_episode(file, info, guess)
-        self.episode_title = self.calc_episode_title(file, info, guess)
+    def init_attributes(self, file, summary, guess):
+        self.season = self.calc_season(file, summary, guess)
+        self.episode = self.calc_episode(file, summary, guess)
+        self.episode_title = self.calc_episode_title(file, summary, guess)
 
-    def calc_season(self, file, info, guess):
+    def calc_season(self, file, summary, guess):
         return guess.get('season', 0)
     
-    def calc_episode(self, file, info, guess):
+    def calc_episode(self, file, summary, guess):
         return guess.get('episodeNumber', 0)
     
-    def calc_episode_title(self, file, info, guess):
+    def calc_episode_title(self, file, summary, guess):
         if self.is_bonus:
             title = self.bonus_title
         else:
@@ -369,7 +415,7 @@ class SeriesScan(AVScanBase):
                 title += " " + eptitle
         return title
     
-    def calc_display_title(self, file, info, guess):
+    def calc_display_title(self, file, summary, guess):
         if self.is_bonus:
             title = self.bonus_title
         else:
@@ -327,7 +327,9 @@ class HomeTheaterMetadata(BaseMetadata):
     def match(self, credit, criteria=None, convert=None):
         if credit is None:
             return True
-        log.debug("match: credit=%s criteria=%s" % (credit, criteria))
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug("match: credit=%s criteria=%s" % (credit, criteria))
         criteria = self.lambdaify(criteria)
         if convert is None:
             convert = lambda d: d
@@ -336,23 +338,28 @@ class HomeTheaterMetadata(BaseMetadata):
             if item is None:
                 return False
             if isinstance(item, basestring):
-                log.debug("match: %s credit=%s, item=%s %s converted=%s result=%s" % (self.title, credit, item, type(item), convert(item), criteria(convert(item))))
+                if debug:
+                    log.debug("match: %s credit=%s, item=%s %s converted=%s result=%s" % (self.title, credit, item, type(item), convert(item), criteria(convert(item))))
                 return criteria(convert(item))
             elif isinstance(item, collections.Iterable):
-                log.debug("match: %s credit=%s, ITERABLE:" % (self.title, credit))
+                if debug:
+                    log.debug("match: %s credit=%s, ITERABLE:" % (self.title, credit))
                 for i in item:
-                    log.debug("  match: item=%s %s converted=%s result=%s" % (i, type(i), convert(i), criteria(convert(i))))
+                    if debug:
+                        log.debug("  match: item=%s %s converted=%s result=%s" % (i, type(i), convert(i), criteria(convert(i))))
                     if criteria(convert(i)):
                         return True
             else:
-                log.debug("match: %s credit=%s, item=%s %s converted=%s result=%s" % (self.title, credit, item, type(item), convert(item), criteria(convert(item))))
+                if debug:
+                    log.debug("match: %s credit=%s, item=%s %s converted=%s result=%s" % (self.title, credit, item, type(item), convert(item), criteria(convert(item))))
                 return criteria(convert(item))
         return False
     
     def iter_items_of(self, credit):
         if hasattr(self, credit):
             item = getattr(self, credit)
-            log.debug("iter_items_of: credit=%s, item=%s %s" % (credit, item, type(item)))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("iter_items_of: credit=%s, item=%s %s" % (credit, item, type(item)))
             if isinstance(item, basestring):
                 yield item
             elif isinstance(item, collections.Iterable):
@@ -1,4 +1,4 @@
-import os, sys
+import os, sys, time, tempfile
 
 from persistent import Persistent
 from PIL import Image
@@ -58,9 +58,92 @@ class BaseMetadata(Persistent):
         return (t, self.year)
 
 
+class PosterIndex(object):
+    """Index of the image files in the poster and icon directories, built
+    from a single directory listing of each directory rather than probing
+    for each extension of each image.
+    
+    A directory is listed again when its modification time changes, but the
+    modification time is only checked every check_interval seconds.
+    """
+    extensions = [".jpg", ".png", ".gif"]
+    
+    check_interval = 5.0
+    
+    def __init__(self):
+        # dirname -> [mtime, last check time, {basename: filename}]
+        self.dirs = {}
+    
+    def list_dir(self, dirname):
+        """Map each image base name in the directory to the filename with the
+        highest priority extension
+        """
+        names = {}
+        priority = {}
+        try:
+            entries = os.listdir(dirname)
+        except OSError:
+            return names
+        for name in entries:
+            base, ext = os.path.splitext(name)
+            if ext in self.extensions:
+                p = self.extensions.index(ext)
+                if base not in priority or p < priority[base]:
+                    priority[base] = p
+                    names[base] = os.path.join(dirname, name)
+        return names
+    
+    def get_names(self, dirname):
+        now = time.time()
+        entry = self.dirs.get(dirname, None)
+        if entry is None or now > entry[1] + self.check_interval:
+            try:
+                mtime = os.stat(dirname).st_mtime
+            except OSError:
+                mtime = None
+            if entry is None or entry[0] != mtime:
+                entry = [mtime, now, self.list_dir(dirname)]
+                self.dirs[dirname] = entry
+            else:
+                entry[1] = now
+        return entry[2]
+    
+    def get_mtime(self, dirname):
+        """Return the modification time of the directory as of the last time
+        it was checked, or None if it doesn't exist.
+        """
+        self.get_names(dirname)
+        return self.dirs[dirname][0]
+    
+    def find(self, path):
+        """Return the filename of the image given the full path without an
+        extension, or None if no image exists.
+        """
+        dirname, base = os.path.split(path)
+        return self.get_names(dirname).get(base, None)
+    
+    def add(self, filename):
+        """Add a newly saved image so it's found without waiting for the
+        directory's modification time to be checked again
+        """
+        dirname, name = os.path.split(filename)
+        base, ext = os.path.splitext(name)
+        if ext in self.extensions:
+            names = self.get_names(dirname)
+            current = names.get(base, None)
+            if current is None or self.extensions.index(ext) <= self.extensions.index(os.path.splitext(current)[1]):
+                names[base] = filename
+            # Force the modification time to be checked on the next lookup so
+            # it reflects the new file
+            self.dirs[dirname][1] = 0
+
+
 class MetadataLoader(object):
     category_map = {}
     
+    # Shared by all loaders because a loader is created for each lookup
+    poster_index = PosterIndex()
+    
     @classmethod
     def get_class(cls, cat, subcat):
         try:
@@ -163,9 +246,15 @@ class MetadataLoader(object):
         """
         path = self.get_poster_filename_from_url(metadata, url, suffix)
         log.debug("Saving %d bytes from %s to %s" % (len(data), url, path))
-        with open(path, "wb") as fh:
+        # Write to a temporary file and rename it so that replacing a poster
+        # changes the modification time of the directory
+        fd, tmppath = tempfile.mkstemp(os.path.splitext(path)[1], "", os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fh:
             fh.write(data)
-        self.scale_poster(path)
+        self.scale_poster(tmppath)
+        os.chmod(tmppath, 0644)
+        os.rename(tmppath, path)
+        self.poster_index.add(path)
     
     def get_poster_filename_from_url(self, metadata, url, suffix=None):
         """Save posters for the metadata instance
@@ -192,11 +281,7 @@ class MetadataLoader(object):
         path = os.path.join(self.metadata_root, metadata.get_path_prefix())
         if suffix is not None:
             path += suffix
-        for ext in [".jpg", ".png", ".gif"]:
-            filename = path + ext
-            if os.path.exists(filename):
-                return filename
-        return None
+        return self.poster_index.find(path)
     
     def get_poster_suffix(self, **kwargs):
         """Loader-specific suffix generator.
@@ -250,7 +335,4 @@ class MetadataLoader(object):
 
     def get_icon(self, icon_code):
         path = os.path.join(self.metadata_root, "icons", icon_code).encode('utf-8')
-        for ext in [".jpg", ".png", ".gif"]:
-            if os.path.exists(path + ext):
-                return path + ext
-        return None
+        return self.poster_index.find(path)
@@ -1,15 +1,25 @@
-import os, sys, glob, time, bisect, logging
+import os, sys, glob, time, bisect, itertools, hashlib, logging
 
 from updates import UpdateManager
 from utils import DBFacade
+from metadata import MetadataLoader
 import settings
 
 log = logging.getLogger("dinoteeth.model")
 
 
 class MenuItem(object):
+    # Menus populated before refresh_time are always repopulated
     refresh_time = time.time()
     
+    # Time of the most recent change of any kind, and the list of (time,
+    # attribute, id) describing the targeted changes since refresh_time
+    change_time = refresh_time
+    change_log = []
+    
+    # Maximum number of changes remembered in change_log
+    change_log_limit = 1000
+    
     def __init__(self, title, enabled=True, action=None, populate_children=None, media=None, metadata=None, **kwargs):
         self.title = title
         self.enabled = enabled
@@ -20,6 +30,7 @@ class MenuItem(object):
         self.parent = None
         self.metadata = metadata
         self.populated = 0
+        self.checked = 0
         self.cursor = 0
         self.children = []
     
@@ -29,8 +40,54 @@ class MenuItem(object):
         return root
     
     @classmethod
-    def needs_refresh(cls):
-        cls.refresh_time = time.time()
+    def needs_refresh(cls, changes=None):
+        """Mark menus as needing to be repopulated
+        
+        @param changes: set of (attribute, id) pairs as recorded by
+        L{DBFacade.mark_changed}.  Only the menus whose populators depend on
+        one of the changes will be repopulated.  If empty or None, the
+        changes are unknown (e.g.  a commit by the update monitor found by
+        L{DBFacade.sync}) so all menus are repopulated.
+        """
+        if not changes:
+            cls.refresh_all()
+            return
+        now = time.time()
+        cls.change_time = now
+        for attr, id in changes:
+            cls.change_log.append((now, attr, id))
+        if len(cls.change_log) > cls.change_log_limit:
+            # Forget the oldest half of the changes, forcing menus populated
+            # before the forgotten changes to be repopulated
+            half = len(cls.change_log) / 2
+            cls.refresh_time = cls.change_log[half - 1][0]
+            cls.change_log = cls.change_log[half:]
+    
+    @classmethod
+    def refresh_all(cls):
+        """Mark all menus as needing to be repopulated"""
+        now = time.time()
+        cls.change_time = now
+        cls.refresh_time = now
+        cls.change_log = []
+    
+    def is_stale(self):
+        if self.populated < self.refresh_time:
+            return True
+        if self.checked >= self.change_time:
+            return False
+        populator = self.populate_children
+        since = max(self.populated, self.checked)
+        i = bisect.bisect_right(self.change_log, (since,))
+        for t, attr, id in self.change_log[i:]:
+            if populator is None or populator.depends_on_change(attr, id):
+                return True
+        self.checked = self.change_time
+        return False
+    
+    def invalidate(self):
+        """Force only this menu to be repopulated on next access"""
+        self.populated = 0
     
     def __cmp__(self, other):
         return cmp(self.title, other.title)
@@ -76,6 +133,7 @@ class MenuItem(object):
         if self.metadata and 'mmdb' in self.metadata:
             base_metadata = self.metadata['mmdb']
             base_metadata.starred = not base_metadata.starred
+            DBFacade.mark_changed("starred", base_metadata.id)
             if base_metadata.starred:
                 log.debug("starred %s" % base_metadata.id)
             else:
@@ -87,11 +145,18 @@ class MenuItem(object):
             media_file = self.metadata['media_file']
         except KeyError:
             return
-        media_file.scan.set_last_position()
-        DBFacade.commit()
+        # Saving the position commits, recording the play change so only the
+        # menus that depend on it are repopulated
+        if 'db' in self.metadata:
+            self.metadata['db'].set_last_position(media_file)
+        else:
+            def before_commit():
+                if media_file.metadata is not None:
+                    DBFacade.mark_changed("play", media_file.metadata.id)
+            media_file.scan.set_last_position(before_commit=before_commit)
     
     def do_populate(self):
-        if self.populated < self.__class__.refresh_time:
+        if self.is_stale():
             if self.populate_children:
                 # root title may have changed
                 if hasattr(self.populate_children, "root_title"):
@@ -100,25 +165,33 @@ class MenuItem(object):
                 data = self.get_cursor_match_data()
                 self.children = []
                 print "populating children!"
-                for child in self.populate_children(self):
-                    self.add(child)
+                if getattr(self.populate_children, "lazy_children", False):
+                    self.children = LazyChildList(self, self.populate_children)
+                else:
+                    for child in self.populate_children(self):
+                        self.add(child)
                 if data is not None:
                     self.set_cursor_from_match_data(data)
             self.populated = time.time()
     
+    def get_child_titles(self):
+        if isinstance(self.children, LazyChildList):
+            return self.children.titles
+        return [child.title for child in self.children]
+    
     def get_cursor_match_data(self):
         if len(self.children) == 0:
             return None
         current_cursor = self.cursor
-        current_title = self.children[current_cursor].title
+        current_title = self.get_child_titles()[current_cursor]
         return (current_cursor, current_title)
     
     def set_cursor_from_match_data(self, data):
         # Attempt to match cursor position by title
         current_cursor, current_title = data
         self.cursor = None
-        for i, child in enumerate(self.children):
-            if child.title == current_title:
+        for i, title in enumerate(self.get_child_titles()):
+            if title == current_title:
                 print "Found cursor position at %s" % current_title.encode('utf8')
                 self.cursor = i
                 break
@@ -239,6 +312,51 @@ class MenuItem(object):
         # probably fail further up the chain.
         return metadata
 
+class LazyChildList(object):
+    """List of child menu items that are only created when they are accessed.
+    
+    The titles (and therefore the sort order) of all children are computed
+    up front, but the populator, the L{MenuItem} and its metadata dict of
+    each child are created the first time the child is needed, which for
+    large menus is usually only when the row is drawn on screen.
+    """
+    def __init__(self, parent, populator):
+        self.parent = parent
+        self.populator = populator
+        entries = list(populator.iter_create_lazy())
+        if populator.autosort:
+            entries.sort(key=lambda e: e[0])
+        self.titles = [e[0] for e in entries]
+        self.factories = [e[1] for e in entries]
+        self.items = [None] * len(entries)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __getitem__(self, index):
+        item = self.items[index]
+        if item is None:
+            factory = self.factories[index]
+            if factory is None:
+                child = None
+            else:
+                child = factory()
+            item = self.populator.create_menu_item(self.titles[index], child)
+            item.parent = self.parent
+            self.items[index] = item
+        return item
+    
+    def __iter__(self):
+        for i in xrange(len(self.items)):
+            yield self[i]
+    
+    def __nonzero__(self):
+        return bool(self.items)
+    
+    def num_created(self):
+        return len(self.items) - self.items.count(None)
+
+
 class Toggle(MenuItem):
     def __init__(self, title, state=False, radio=None, index=0, **kwargs):
         MenuItem.__init__(self, title, **kwargs)
@@ -283,6 +401,10 @@ class Toggle(MenuItem):
 class MenuPopulator(object):
     autosort = False
     
+    # If True, the menu items are created on demand from the (title,
+    # factory) pairs of iter_create_lazy rather than from iter_create
+    lazy_children = False
+    
     def __init__(self, config):
         self.config = config
         self.children = []
@@ -295,20 +417,43 @@ class MenuPopulator(object):
         if self.autosort:
             items.sort()
         for title, populator in items:
-            item = MenuItem(title, populate_children=populator)
-            if populator is None:
-                item.enabled = False
-            if hasattr(populator, 'play'):
-                item.action=populator.play
-            if hasattr(populator, 'get_metadata'):
-                item.metadata = populator.get_metadata()
-            if hasattr(populator, 'on_selected_item'):
-                item.on_selected_item = populator.on_selected_item
-            yield item
+            yield self.create_menu_item(title, populator)
+    
+    def create_menu_item(self, title, populator):
+        item = MenuItem(title, populate_children=populator)
+        if populator is None:
+            item.enabled = False
+        if hasattr(populator, 'play'):
+            item.action=populator.play
+        if hasattr(populator, 'get_metadata'):
+            item.metadata = populator.get_metadata()
+        if hasattr(populator, 'on_selected_item'):
+            item.on_selected_item = populator.on_selected_item
+        return item
     
     def iter_create(self):
         return []
     
+    def depends_on_change(self, attr, id):
+        """Return True if the menu created by this populator needs to be
+        repopulated because of a change recorded by L{DBFacade.mark_changed}
+        """
+        return True
+    
+    def iter_create_lazy(self):
+        """Generate (title, factory) pairs for each child, where calling
+        factory returns the child's populator.  A factory of None indicates
+        a disabled heading.
+        
+        The default creates the populators immediately; subclasses with
+        large menus should defer the work to the factory.
+        """
+        for title, populator in self.iter_create():
+            if populator is None:
+                yield title, None
+            else:
+                yield title, lambda p=populator: p
+    
     def iter_image_path(self):
         return []
     
@@ -326,50 +471,121 @@ class MenuPopulator(object):
     
     def get_mosaic_size(self):
         return 100, 140
+    
+    # ((database generation, w, h), [(dirname, mtime), ...], key) of the
+    # last mosaic key computed
+    mosaic_key_cache = None
+    
+    def get_mosaic_key(self, w, h):
+        """Return a key that identifies the mosaic drawn in a box of the
+        given size: the populator class, the layout, the images that fit in
+        the box and the modification times of their directories.
+        
+        The directory times come from the poster index, so computing the key
+        doesn't stat every image.  Replacing an image changes the time of
+        its directory as long as it's replaced by a rename, as posters are.
+        The key is only computed again when the database or one of the
+        directories has changed.
+        """
+        poster_index = MetadataLoader.poster_index
+        cache = self.mosaic_key_cache
+        state = (DBFacade.generation, w, h)
+        if cache is not None and cache[0] == state:
+            for dirname, mtime in cache[1]:
+                if poster_index.get_mtime(dirname) != mtime:
+                    break
+            else:
+                return cache[2]
+        nominal_x, nominal_y = self.get_mosaic_size()
+        slots = (w / nominal_x) * (h / nominal_y)
+        parts = [self.__class__.__name__, w, h, nominal_x, nominal_y]
+        dirnames = set()
+        for imgpath in itertools.islice(self.iter_image_path(), slots):
+            parts.append(imgpath)
+            dirnames.add(os.path.dirname(imgpath))
+        dirs = [(dirname, poster_index.get_mtime(dirname)) for dirname in sorted(dirnames)]
+        parts.extend(dirs)
+        key = hashlib.md5(repr(parts)).hexdigest()
+        self.mosaic_key_cache = (state, dirs, key)
+        return key
+    
+    def save_mosaic(self, window, key, w, h, placed):
+        """Save a completely drawn mosaic so that it can be displayed with a
+        single blit next time.  The mosaic is composited in the background.
+        
+        @param placed: list of (image, x, y) of each thumbnail relative to
+        the upper left corner of the mosaic
+        """
+        if key is not None and placed:
+            UpdateManager.create_mosaic(key, (w, h), [(image.filename, dx, dy) for image, dx, dy in placed])
 
-    def thumbnail_mosaic_all_at_once(self, window, x, y, w, h):
+    def thumbnail_mosaic_all_at_once(self, window, x, y, w, h, key=None):
         nominal_x, nominal_y = self.get_mosaic_size()
         min_x = x
         max_x = x + w
         min_y = y
-        y = y + h
+        top = y = y + h
+        placed = []
+        complete = True
         for imgpath in self.iter_image_path():
             thumb_image = self.get_thumbnail(window, imgpath)
             if thumb_image is None:
+                complete = False
                 continue
             if x + nominal_x > max_x:
                 x = min_x
                 y -= nominal_y
             if y < min_y:
                 break
-            window.blit(thumb_image, x + (nominal_x - thumb_image.width) / 2, y - nominal_y + (nominal_y - thumb_image.height) / 2)
+            if not thumb_image.is_valid():
+                complete = False
+            bx = x + (nominal_x - thumb_image.width) / 2
+            by = y - nominal_y + (nominal_y - thumb_image.height) / 2
+            placed.append((thumb_image, bx - min_x, top - by - thumb_image.height))
+            window.blit(thumb_image, bx, by)
             x += nominal_x
+        if complete:
+            self.save_mosaic(window, key, w, h, placed)
 
-    def thumbnail_mosaic_incremental(self, window, x, y, w, h):
+    def thumbnail_mosaic_incremental(self, window, x, y, w, h, key=None):
         print "thumbnail_mosaic_incremental"
-        iterator = self.thumbnail_mosaic_iterator(window, x, y, w, h)
-        window.schedule_draw_iterator(iterator)
+        iterator = self.thumbnail_mosaic_iterator(window, x, y, w, h, key)
+        window.schedule_draw_iterator(iterator, (x, y, w, h))
     
     def thumbnail_mosaic(self, window, x, y, w, h):
+        key = self.get_mosaic_key(w, h)
+        try:
+            image = window.get_mosaic_image(key)
+            if image is not None:
+                window.clear_rect(x, y, w, h)
+                window.blit(image, x, y)
+                return
+        except RuntimeError, e:
+            # The mosaic may have been removed from the disk cache
+            log.debug("Failed drawing mosaic %s: %s" % (key, e))
+            window.forget_mosaic_image(key)
         if not settings.delayed_rendering:
-            self.thumbnail_mosaic_all_at_once(window, x, y, w, h)
+            self.thumbnail_mosaic_all_at_once(window, x, y, w, h, key)
         else:
-            self.thumbnail_mosaic_incremental(window, x, y, w, h)
+            self.thumbnail_mosaic_incremental(window, x, y, w, h, key)
     
     draw_rows = False
     
-    def thumbnail_mosaic_iterator(self, window, x, y, w, h):
+    def thumbnail_mosaic_iterator(self, window, x, y, w, h, key=None):
         print "thumbnail_mosaic_iterator: start"
         window.clear_rect(x, y, w, h)
         nominal_x, nominal_y = self.get_mosaic_size()
         min_x = x
         max_x = x + w
         min_y = y
-        y = y + h
+        top = y = y + h
+        placed = []
+        complete = True
         for imgpath in self.iter_image_path():
             print "thumbnail_mosaic_iterator: in loop"
             thumb_image = self.get_thumbnail(window, imgpath)
             if thumb_image is None:
+                complete = False
                 continue
             print imgpath
             if x + nominal_x > max_x:
@@ -379,8 +595,15 @@ class MenuPopulator(object):
                     yield True
             if y - nominal_y < min_y:
                 yield True
-                raise StopIteration
-            window.blit(thumb_image, x + (nominal_x - thumb_image.width) / 2, y - nominal_y + (nominal_y - thumb_image.height) / 2)
+                break
+            if not thumb_image.is_valid():
+                complete = False
+            bx = x + (nominal_x - thumb_image.width) / 2
+            by = y - nominal_y + (nominal_y - thumb_image.height) / 2
+            placed.append((thumb_image, bx - min_x, top - by - thumb_image.height))
+            window.blit(thumb_image, bx, by)
             x += nominal_x
             if not self.draw_rows:
                 yield True
+        if complete:
+            self.save_mosaic(window, key, w, h, placed)
@@ -1,4 +1,4 @@
-import os, sys, glob, logging, subprocess
+import os, sys, logging, subprocess
 
 import utils
 
@@ -18,11 +18,10 @@ class PhotoDB(object):
     def hierarchy(self):
         dirs = []
         for path in self.paths:
-            dirs.extend(glob.glob(os.path.join(path, "*")))
+            dirs.extend(utils.iter_subdirs(path))
         dirs.sort()
         for dir in dirs:
-            if os.path.isdir(dir):
-                self.children.append(PhotoDir(dir))
+            self.children.append(PhotoDir(dir))
         print self.children
         return self
 
@@ -54,21 +53,28 @@ class PhotoFolder(MenuPopulator):
         self.path = path
     
     def iter_create(self):
-        dirs = glob.glob(os.path.join(self.path, "*"))
+        dirs = list(utils.iter_subdirs(self.path))
         dirs.sort()
         for path in dirs:
-            if os.path.isdir(path):
-                files = glob.glob(os.path.join(path, "*"))
-                pictures = [f for f in files if os.path.splitext(f)[1].lower() in Pictures.valid_file_types]
-                videos = [f for f in files if os.path.splitext(f)[1].lower()[1:] in HomeVideos.valid_file_types]
-                if pictures:
-                    yield utils.decode_title_text(os.path.basename(path)), Pictures(self.config, path)
-                if videos:
-                    yield utils.decode_title_text(os.path.basename(path)) + " (videos)", HomeVideos(self.config, videos)
-                if not pictures and not videos:
-                    subdirs = [d for d in files if os.path.isdir(d)]
-                    if subdirs:
-                        yield utils.decode_title_text(os.path.basename(path)) + " (folders)", PhotoFolder(self.config, path)
+            pictures = False
+            videos = []
+            subdirs = False
+            for entry in utils.iter_dir_entries(path):
+                if entry.is_dir():
+                    subdirs = True
+                    continue
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext in Pictures.valid_file_types:
+                    pictures = True
+                elif ext[1:] in HomeVideos.valid_file_types:
+                    videos.append(entry.path)
+            if pictures:
+                yield utils.decode_title_text(os.path.basename(path)), Pictures(self.config, path)
+            if videos:
+                videos.sort()
+                yield utils.decode_title_text(os.path.basename(path)) + " (videos)", HomeVideos(self.config, videos)
+            if not pictures and not videos and subdirs:
+                yield utils.decode_title_text(os.path.basename(path)) + " (folders)", PhotoFolder(self.config, path)
 
 class Pictures(MenuPopulator):
     valid_file_types = ['.jpg', '.png', '.gif']
@@ -78,13 +84,14 @@ class Pictures(MenuPopulator):
         self.path = path
     
     def iter_image_path(self):
-        images = glob.glob(os.path.join(self.path, "*"))
+        images = []
+        for entry in utils.iter_dir_entries(self.path):
+            _, ext = os.path.splitext(entry.name)
+            if ext.lower() in self.valid_file_types and not entry.is_dir():
+                images.append(entry.path)
         images.sort()
         for image in images:
-            if not os.path.isdir(image):
-                _, ext = os.path.splitext(image)
-                if ext.lower() in self.valid_file_types:
-                    yield image
+            yield image
 
     def play(self, config=None):
         self.config.prepare_for_external_app()
@@ -16,6 +16,18 @@ top_margin = integer(default=0)
 bottom_margin = integer(default=0)
 window_width = integer(default=1366)
 window_height = integer(default=768)
+mosaic_disk_cache_size = integer(min=0, default=64)
+image_cache_size = integer(min=0, default=64)
+text_cache_size = integer(min=0, default=512)
+text_cache_budget = integer(min=0, default=32)
+frame_budget = integer(min=1, default=8)
+frame_interval = integer(min=1, default=16)
+
+[scan]
+probe_processes = integer(min=0, default=1)
+commit_batch_size = integer(min=0, default=500)
+commit_interval = float(min=0, default=30.0)
+update_settle_time = float(min=0, default=10.0)
 
 [fonts]
 font_name = string(default="Liberation Sans")
@@ -1,4 +1,4 @@
-import os, time, logging, threading, multiprocessing, Queue
+import os, time, logging, threading, multiprocessing, Queue, heapq
 
 # Utilities for thread and process based tasks
 
@@ -249,58 +249,107 @@ class ProcessTaskDispatcher(ThreadTaskDispatcher):
                 break
 
 
-class Timer(threading.Thread):
-    def __init__(self, event_callback, resolution=.2):
+class Scheduler(threading.Thread):
+    """Thread that runs callbacks when their deadlines are reached.
+    
+    Rather than waking up at a fixed resolution, the thread sleeps on a
+    condition variable until the earliest pending deadline (or until a new
+    deadline is added), so it uses no CPU when nothing is scheduled.
+    
+    Each due callback is passed to the dispatch callable, which can call it
+    directly in this thread or (as the SDL window does) post an event so
+    it's called in the main thread.
+    """
+    def __init__(self, dispatch=None):
         threading.Thread.__init__(self)
-        self._event_callback = event_callback
-        self._event = threading.Event()
-        self._resolution = resolution
-        self._expire_time = time.time()
+        if dispatch is None:
+            dispatch = lambda callback: callback()
+        self._dispatch = dispatch
+        self._condition = threading.Condition()
+        
+        # Heap of [deadline, sequence number, callback] entries, and the
+        # pending entry for each callback.  Unscheduled entries are left in
+        # the heap with the callback set to None.
+        self._heap = []
+        self._entries = {}
+        self._counter = 0
         self._want_abort = False
         self.start()
 
     def run(self):
-        while self._event.wait():
-            while self._event.is_set():
+        while True:
+            with self._condition:
+                while not self._want_abort:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
                 if self._want_abort:
                     return
-                time.sleep(self._resolution)
-#                print "timer!!!!"
-                self._event_callback()
-                if time.time() > self._expire_time:
-                    self.stop_ticks()
-            if self._want_abort:
-                return
-            self._event_callback()
-
-    def start_ticks(self, resolution, expire_time):
-        self._resolution = resolution
-        self._expire_time = expire_time
-        self._event.set()
-
-    def stop_ticks(self):
-        if not self._want_abort:
-            self._event.clear()
-        print "Timer.stop_ticks: timer expired!!!"
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, count, callback = heapq.heappop(self._heap)
+                    if callback is not None:
+                        del self._entries[callback]
+                        due.append(callback)
+            # Dispatch outside the lock so the callbacks are free to
+            # schedule again
+            for callback in due:
+                self._dispatch(callback)
+
+    def schedule(self, deadline, callback):
+        """Call the callback at the specified time, replacing any previously
+        scheduled time for the same callback
+        
+        @param deadline: time in seconds since the epoch, as from time.time()
+        """
+        with self._condition:
+            self._remove(callback)
+            self._counter += 1
+            entry = [deadline, self._counter, callback]
+            self._entries[callback] = entry
+            heapq.heappush(self._heap, entry)
+            self._condition.notify()
+    
+    def unschedule(self, callback):
+        """Remove the callback if it hasn't been dispatched yet
+        
+        """
+        with self._condition:
+            self._remove(callback)
+    
+    def _remove(self, callback):
+        entry = self._entries.pop(callback, None)
+        if entry is not None:
+            entry[2] = None
 
     def abort(self):
-        print "Timer.abort: stopping timer!!!"
-        self._want_abort = True
-        self._event.set()
+        with self._condition:
+            self._want_abort = True
+            self._condition.notify()
 
 class TaskManager(object):
-    def __init__(self, event_callback):
+    def __init__(self, event_callback, timer_callback=None):
+        """
+        @param timer_callback: called from the scheduler thread with each
+        scheduled callback when it's due; if None, the scheduled callbacks
+        are called directly in the scheduler thread.
+        """
         log = logging.getLogger(self.__class__.__name__)
         self.event_callback = event_callback
         self._finished = Queue.Queue()
         self.dispatchers = []
-        self.timer = Timer(event_callback)
+        self.scheduler = Scheduler(timer_callback)
     
-    def start_ticks(self, resolution, expire_time):
-        self.timer.start_ticks(resolution, expire_time)
+    def schedule(self, deadline, callback):
+        self.scheduler.schedule(deadline, callback)
     
-    def stop_ticks(self):
-        self.timer.stop_ticks()
+    def unschedule(self, callback):
+        self.scheduler.unschedule(callback)
 
     def find_dispatcher(self, task):
         for dispatcher in self.dispatchers:
@@ -387,10 +436,10 @@ class TaskManager(object):
     def shutdown(self):
         for dispatcher in self.dispatchers:
             dispatcher.abort()
-        self.timer.abort()
+        self.scheduler.abort()
         for dispatcher in self.dispatchers:
             dispatcher.join()
-        self.timer.join()
+        self.scheduler.join()
 
 
 if __name__ == '__main__':
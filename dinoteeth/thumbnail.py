@@ -8,7 +8,7 @@ support PIL rather than GTK for image creation.
 Original GPL source: http://comix.svn.sourceforge.net/viewvc/comix/trunk/src/thumbnail.py?revision=321&view=markup
 """
 
-import os, tempfile, mimetypes, subprocess
+import os, tempfile, mimetypes, subprocess, collections
 from cStringIO import StringIO
 from urllib import pathname2url, url2pathname
 from hashlib import md5
@@ -226,14 +226,127 @@ class VideoThumbnailFactory(AbstractThumbnailFactory):
         return thumbpath
 
 
+class MosaicFactory(object):
+    """Cache of thumbnail mosaics composited into a single image, stored by
+    the key computed from the populator and the images in the mosaic.
+    
+    The cache is limited to max_bytes on disk, removing the least recently
+    used mosaics first.  The usage order is kept in memory by the process
+    displaying the mosaics (starting from the files' modification times), so
+    looking up a known mosaic doesn't touch the disk.  Mosaics are created
+    in another process, so a key that isn't known yet is checked on disk.
+    """
+    def __init__(self, basedir, max_bytes=None):
+        self.basedir = basedir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.basedir):
+            os.makedirs(self.basedir, 0700)
+        
+        # key -> file size, in least to most recently used order
+        self.files = None
+        self.total = 0
+    
+    def _key_to_path(self, key):
+        return os.path.join(self.basedir, key + '.png')
+    
+    def load_files(self):
+        entries = []
+        for name in os.listdir(self.basedir):
+            if not name.endswith('.png'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.basedir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name[:-4], st.st_size))
+        entries.sort()
+        self.files = collections.OrderedDict()
+        self.total = 0
+        for mtime, key, size in entries:
+            self.files[key] = size
+            self.total += size
+    
+    def get_mosaic_file(self, key):
+        if self.files is None:
+            self.load_files()
+        path = self._key_to_path(key)
+        size = self.files.pop(key, None)
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return None
+            self.total += size
+            self.files[key] = size
+            self.prune()
+        else:
+            self.files[key] = size
+        return path
+    
+    def forget_mosaic_file(self, key):
+        """Remove the mosaic from the cache, e.g.  if it can't be loaded
+        
+        """
+        if self.files is not None and key in self.files:
+            self.total -= self.files.pop(key)
+            try:
+                os.remove(self._key_to_path(key))
+            except OSError:
+                pass
+    
+    def prune(self):
+        """Remove the least recently used mosaics until the cache fits in
+        max_bytes.  The most recently used mosaic is always kept.
+        """
+        if self.max_bytes is None:
+            return
+        while self.total > self.max_bytes and len(self.files) > 1:
+            key, size = self.files.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self._key_to_path(key))
+            except OSError:
+                pass
+    
+    def create_mosaic(self, key, size, placements):
+        """Paste the thumbnails at the given positions into a new image
+        
+        @param size: (width, height) tuple of the mosaic
+        @param placements: list of (thumbnail path, x, y) where x and y are
+        relative to the upper left corner
+        """
+        img = Image.new('RGB', size, (0, 0, 0))
+        try:
+            for thumbpath, x, y in placements:
+                thumb = Image.open(thumbpath)
+                if thumb.mode == 'RGBA':
+                    img.paste(thumb, (x, y), thumb)
+                else:
+                    img.paste(thumb, (x, y))
+        except Exception, e:
+            print '! thumbnail.py: Could not create mosaic', key, e
+            return None
+        path = self._key_to_path(key)
+        try:
+            tmppath = tempfile.mkstemp(".png","",self.basedir)[1]
+            img.save(tmppath, "PNG")
+            os.rename(tmppath, path)
+            os.chmod(path, 0600)
+        except Exception:
+            print '! thumbnail.py: Could not write', path, '\n'
+            return None
+        return path
+
+
 class ThumbnailFactory(object):
-    def __init__(self, local_basedir=None, shared_basedir=None, image_size=128, video_size=512):
+    def __init__(self, local_basedir=None, shared_basedir=None, image_size=128, video_size=512, mosaic_cache_bytes=None):
         self.image = ImageThumbnailFactory(local_basedir, image_size)
         self.shared_basedir = shared_basedir
         if shared_basedir is not None:
             thumbnail_dir = os.path.join(shared_basedir, "thumbnails")
             self.image_shared = ImageThumbnailFactory(thumbnail_dir, image_size)
         self.video = VideoThumbnailFactory(local_basedir, video_size)
+        self.mosaic = MosaicFactory(os.path.join(self.image.basedir, "mosaics"), mosaic_cache_bytes)
     
     def which(self, imgpath):
         ext = os.path.splitext(imgpath)[1].lower()
@@ -258,6 +371,15 @@ class ThumbnailFactory(object):
     def _path_to_thumbpath(self, imgpath):
         which = self.which(imgpath)
         return which._path_to_thumbpath(imgpath)
+    
+    def get_mosaic_file(self, key):
+        return self.mosaic.get_mosaic_file(key)
+    
+    def forget_mosaic_file(self, key):
+        return self.mosaic.forget_mosaic_file(key)
+    
+    def create_mosaic(self, key, size, placements):
+        return self.mosaic.create_mosaic(key, size, placements)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
 import os, Queue, functools, time
 
 class MainWindow(object):
+    layout = None
+    
     def __init__(self, config, factory, fullscreen=True, width=800, height=600, margins=None,
                  thumbnails=None):
         if margins is None:
@@ -91,6 +93,22 @@ class MainWindow(object):
         """
         raise RuntimeError("Abstract method")
     
+    ########## Screen update functions
+    
+    def mark_dirty(self, x, y, w, h):
+        """Mark a region of the window as needing to be copied to the screen
+        on the next update.  Windowing systems that always update the entire
+        screen can ignore this.
+        
+        """
+        pass
+    
+    def mark_all_dirty(self):
+        """Mark the entire window as needing to be copied to the screen
+        
+        """
+        pass
+    
     ########## Drawing functions
     
     def clip(self, x, y, w, h):
@@ -102,6 +120,15 @@ class MainWindow(object):
     def clear_rect(self, x, y, w, h):
         raise RuntimeError("Abstract method")
     
+    def scroll_rect(self, x, y, w, h, dy):
+        """Move the contents of a region of the window up by dy pixels (or
+        down if negative), leaving the uncovered part of the region as is.
+        
+        @returns: True if the window supports scrolling, otherwise False
+        and the caller has to redraw the region.
+        """
+        return False
+    
     def draw_text(self, text, font, x=0, y=0, bold=False, italic=False, color=None, anchor_x='left', anchor_y='bottom'):
         raise RuntimeError("Abstract method")
     
@@ -133,6 +160,28 @@ class MainWindow(object):
         thumbpath = self.get_thumbnail_file(filename)
         return self.get_image(thumbpath)
     
+    def get_mosaic_image(self, key):
+        """Return the image of a previously composited thumbnail mosaic, or
+        None if it hasn't been created yet.
+        
+        The mosaic is loaded from the mosaic cache on disk through
+        L{get_image}, so recently used mosaics are held in memory by the same
+        cache as any other image.
+        """
+        if self.thumbnail_loader is None:
+            return None
+        path = self.thumbnail_loader.get_mosaic_file(key)
+        if path is None:
+            return None
+        return self.get_image(path)
+    
+    def forget_mosaic_image(self, key):
+        """Remove a mosaic from the mosaic cache, e.g. if it can't be loaded
+        
+        """
+        if self.thumbnail_loader is not None:
+            self.thumbnail_loader.forget_mosaic_file(key)
+    
     def blit(self, image, x, y, depth=0):
         """Blit the entire image to the window with upper left corner at
         the position specified.
@@ -153,6 +202,7 @@ class FontInfo(object):
 
 class BaseImage(object):
     def __init__(self, filename):
+        self.filename = filename
         self.width = 0
         self.height = 0
         self.image = None
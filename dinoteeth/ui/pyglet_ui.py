@@ -62,6 +62,7 @@ class PygletMainWindow(pyglet.window.Window, MainWindow):
     
     def on_draw(self):
         self.clear()
+        self.layout.mark_changed("all")
         self.layout.draw()
     
     def refresh(self):
@@ -1,9 +1,12 @@
-import os, time, ctypes, __builtin__
+import os, time, ctypes, collections, logging, __builtin__
 
 import SDL, SDL_Image, SDL_Pango, SDL_gfx
 
 from .base import MainWindow, FontInfo, BaseImage
 from ..updates import UpdateManager
+from .. import settings
+
+log = logging.getLogger("dinoteeth.sdl_ui")
 
 def escape_markup(text):
     return unicode(text).replace(u"&", u"&amp;")
@@ -27,6 +30,9 @@ class SdlMainWindow(MainWindow):
         self.monitor_size = (info.contents.current_w, info.contents.current_h)
         self.window_size = (width, height)
         self.create_screen(fullscreen)
+        self.surface_cache = SurfaceCache(settings.image_cache_size * 1024 * 1024)
+        self.text_cache = TextCache(settings.text_cache_size,
+                                    settings.text_cache_budget * 1024 * 1024)
         MainWindow.__init__(self, config, factory, fullscreen, width, height, margins,
                             thumbnails)
         __builtin__._ = escape_markup
@@ -50,6 +56,12 @@ class SdlMainWindow(MainWindow):
         self.height = self.screen.contents.h
         if fullscreen:
             SDL.SDL_ShowCursor(SDL.SDL_DISABLE)
+        
+        # The new screen is blank, so everything has to be redrawn
+        self.dirty_rects = []
+        self.all_dirty = True
+        if self.layout is not None:
+            self.layout.mark_changed("all")
     
     def set_using_external_app(self, state, fullscreen):
         MainWindow.set_using_external_app(self, state, fullscreen)
@@ -68,6 +80,34 @@ class SdlMainWindow(MainWindow):
     
     def flip(self):
         SDL.SDL_Flip(self.screen)
+        self.dirty_rects = []
+        self.all_dirty = False
+    
+    def mark_dirty(self, x, y, w, h):
+        # Convert to SDL coordinates and clamp to the screen, because
+        # SDL_UpdateRects doesn't accept rects that extend past the edges
+        left = max(0, x)
+        right = min(self.width, x + w)
+        top = max(0, self.height - y - h)
+        bottom = min(self.height, self.height - y)
+        if right > left and bottom > top:
+            self.dirty_rects.append(SDL.SDL_Rect(left, top, right - left, bottom - top))
+    
+    def mark_all_dirty(self):
+        self.all_dirty = True
+    
+    def update(self):
+        """Copy only the dirty regions to the screen, or the entire screen
+        if everything has been redrawn.
+        
+        """
+        if self.all_dirty:
+            self.flip()
+        elif self.dirty_rects:
+            count = len(self.dirty_rects)
+            rects = (SDL.SDL_Rect * count)(*self.dirty_rects)
+            SDL.SDL_UpdateRects(self.screen, count, rects)
+            self.dirty_rects = []
     
     def clear(self):
         SDL.SDL_FillRect(self.screen, None, 0)
@@ -86,28 +126,66 @@ class SdlMainWindow(MainWindow):
         ev = SDL.SDL_Event()
         while self.running:
             self.on_draw()
-            self.flip()
-            while SDL.SDL_WaitEvent(SDL.pointer(ev)) == 1:
-                if ev.type == SDL.SDL_KEYDOWN:
-                    self.controller.process_key_press(ev.key.keysym.sym,
-                                                      ev.key.keysym.mod)
+            self.update()
+            while True:
+                if self.draw_iterator is not None:
+                    # While there's something left to draw, only wait for
+                    # events until the next frame is due.  Events are checked
+                    # between frames, so a key press that moves the selection
+                    # cancels the iterator within one frame.
+                    if not self.wait_event(ev, self.next_frame - time.time()):
+                        self.run_draw_iterator()
+                        continue
+                elif SDL.SDL_WaitEvent(SDL.pointer(ev)) != 1:
+                    break
+                if self.process_event(ev):
                     break
-                elif ev.type == SDL.SDL_MOUSEMOTION:
-                    pass
-                elif ev.type == SDL.SDL_QUIT:
-                    self.quit()
-                elif ev.type == SDL.SDL_USEREVENT:
-                    argid = int(ev.user.data1)
-                    user_data = self.event_data.pop(argid)
-#                    print "User event! code=%d data1=%s user_data=%s" % (ev.user.code, ev.user.data1, str(user_data))
-                    func_name = self.event_code_to_callback[ev.user.code]
-                    callback = getattr(self, func_name)
-                    retval = callback(*user_data)
-                    if retval == "force redraw":
-                        break
                 
             UpdateManager.process_tasks()
     
+    # SDL 1.2 has no way to wait for an event with a timeout, so wait_event
+    # sleeps in short intervals between checks like SDL_WaitEvent does
+    event_wait_interval = 0.002
+    
+    def wait_event(self, ev, timeout):
+        """Wait up to timeout seconds for an event
+        
+        @returns: True if an event was stored in ev
+        """
+        deadline = time.time() + timeout
+        while True:
+            if SDL.SDL_PollEvent(SDL.pointer(ev)):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(remaining, self.event_wait_interval))
+    
+    def process_event(self, ev):
+        """Handle a single SDL event
+        
+        @returns: True if the screen needs to be redrawn
+        """
+        if ev.type == SDL.SDL_KEYDOWN:
+            self.controller.process_key_press(ev.key.keysym.sym,
+                                              ev.key.keysym.mod)
+            return True
+        elif ev.type == SDL.SDL_MOUSEMOTION:
+            pass
+        elif ev.type == SDL.SDL_QUIT:
+            self.quit()
+            return True
+        elif ev.type == SDL.SDL_USEREVENT:
+            argid = int(ev.user.data1 or 0)
+            user_data = self.event_data.pop(argid, ())
+#            print "User event! code=%d data1=%s user_data=%s" % (ev.user.code, ev.user.data1, str(user_data))
+            func_name = self.event_code_to_callback[ev.user.code]
+            callback = getattr(self, func_name)
+            retval = callback(*user_data)
+            if retval == "force redraw":
+                return True
+        return False
+    
     def on_draw(self):
         self.layout.draw()
     
@@ -131,7 +209,8 @@ class SdlMainWindow(MainWindow):
         event_code_to_callback[code] = callback
     
     # Rather that trying to marshal python arguments into the SDL event, store
-    # the python event data a dict and reference it by number.
+    # the python event data a dict and reference it by number.  Events
+    # without arguments don't use the dict.
     event_data_counter = 1
     event_data = {}
     
@@ -139,31 +218,85 @@ class SdlMainWindow(MainWindow):
         ev = SDL.SDL_Event()
         ev.type = SDL.SDL_USEREVENT
         ev.user.code = self.known_events[event]
-        argcopy = tuple(args)
-        argid = self.event_data_counter
-        self.event_data_counter += 1
-        data1 = ctypes.cast(argid, ctypes.c_void_p)
-        self.event_data[argid] = argcopy
-        ev.user.data1 = data1
+        if args:
+            argid = self.event_data_counter
+            self.event_data_counter += 1
+            self.event_data[argid] = tuple(args)
+            ev.user.data1 = ctypes.cast(argid, ctypes.c_void_p)
         SDL.SDL_PushEvent(SDL.pointer(ev))
     
     ########## Timer functions
     
-    scheduled = {}
-    timer_resolution = .02
+    # Callbacks are scheduled in the update manager's scheduler thread, which
+    # posts an on_timer event with the callback when it's due so that it's
+    # called in the main thread.
     
     def schedule_once(self, callback, seconds):
-        scheduled_time = time.time() + seconds
-        self.scheduled[callback] = scheduled_time
-        UpdateManager.start_ticks(self.timer_resolution, scheduled_time)
+        UpdateManager.schedule(time.time() + seconds, callback)
+    
+    def unschedule(self, callback):
+        UpdateManager.unschedule(callback)
+    
+    def on_timer(self, callback):
+        callback()
+        return "force redraw"
     
     def clear_draw_iterator(self):
+        if self.draw_iterator is not None:
+            log.debug("draw iterator cancelled after %d steps in %d frames" % (self.draw_steps, self.draw_frames))
         self.draw_iterator = None
     
-    def schedule_draw_iterator(self, iterator):
-        scheduled_time = time.time() + 2000
+    def schedule_draw_iterator(self, iterator, box=None):
+        """Draw using the iterator whenever the event loop is idle, running
+        as many steps as fit in the frame budget each time.
+        
+        @param box: (x, y, w, h) region drawn by the iterator, which is
+        updated on screen after every frame so the drawing appears
+        progressively.  If None, the entire screen is flipped when the
+        iterator completes.
+        """
         self.draw_iterator = iterator
-        UpdateManager.start_ticks(self.timer_resolution, scheduled_time)
+        self.draw_iterator_box = box
+        self.next_frame = time.time()
+        self.draw_steps = 0
+        self.draw_frames = 0
+        self.draw_time = 0.0
+        self.max_frame_time = 0.0
+    
+    def run_draw_iterator(self):
+        """Advance the draw iterator for one frame's worth of steps
+        
+        The steps use at most frame_budget milliseconds, and the next frame
+        is due frame_interval milliseconds after this one starts, so the
+        event loop waits for events for the rest of the interval.
+        """
+        start = time.time()
+        deadline = start + settings.frame_budget / 1000.0
+        self.next_frame = start + settings.frame_interval / 1000.0
+        steps = 0
+        done = False
+        try:
+            while True:
+                self.draw_iterator.next()
+                steps += 1
+                if time.time() >= deadline:
+                    break
+        except StopIteration:
+            done = True
+        elapsed = time.time() - start
+        self.draw_steps += steps
+        self.draw_frames += 1
+        self.draw_time += elapsed
+        self.max_frame_time = max(self.max_frame_time, elapsed)
+        log.debug("draw iterator frame %d: %d steps in %.1f ms" % (self.draw_frames, steps, elapsed * 1000))
+        if done:
+            log.debug("draw iterator finished: %d steps in %d frames, %.1f ms total, longest frame %.1f ms" % (self.draw_steps, self.draw_frames, self.draw_time * 1000, self.max_frame_time * 1000))
+            self.draw_iterator = None
+        if self.draw_iterator_box is not None:
+            self.mark_dirty(*self.draw_iterator_box)
+            self.update()
+        elif done:
+            self.flip()
     
     def on_timer_tick(self, text=None):
         if self.using_external_app:
@@ -173,41 +306,6 @@ class SdlMainWindow(MainWindow):
             if time.time() > self.next_allowed_status_update:
                 self.next_allowed_status_update = time.time() + self.status_update_interval
                 #return "force redraw"
-        if self.draw_iterator:
-            print "draw_iterator"
-            try:
-                print "draw_iterator: calling"
-                drawn = self.draw_iterator.next()
-                print "draw_iterator: called"
-            except StopIteration:
-                print "draw_iterator: ended"
-                scheduled_time = time.time() + 2
-                UpdateManager.start_ticks(self.timer_resolution, scheduled_time)
-                self.flip()
-                self.draw_iterator = None
-    
-    def unschedule(self, callback):
-        if callback in self.scheduled:
-            del self.scheduled[callback]
-    
-    def on_timer(self, *args):
-        if not self.scheduled:
-            # Short circuit so that stop_ticks isn't endlessly called
-            return
-        now = time.time()
-        still_pending = {}
-        called = False
-        for callback, execute_time in self.scheduled.iteritems():
-            if now >= execute_time:
-                callback()
-                called = True
-            else:
-                still_pending[callback] = execute_time
-        self.scheduled = still_pending
-        if not self.scheduled:
-            UpdateManager.stop_ticks()
-        if called:
-            return "force redraw"
     
     ########## Drawing functions
     
@@ -223,6 +321,20 @@ class SdlMainWindow(MainWindow):
         print "clearing %s" % str((x, self.height - y - h, w, h))
         SDL.SDL_FillRect(self.screen, SDL.pointer(destrect), 0)
     
+    def scroll_rect(self, x, y, w, h, dy):
+        if dy == 0 or abs(dy) >= h:
+            return True
+        top = self.height - y - h
+        if dy > 0:
+            srcrect = SDL.SDL_Rect(x, top + dy, w, h - dy)
+            destrect = SDL.SDL_Rect(x, top, 0, 0)
+        else:
+            srcrect = SDL.SDL_Rect(x, top, w, h + dy)
+            destrect = SDL.SDL_Rect(x, top - dy, 0, 0)
+        # SDL handles blits within the same surface as overlapping copies
+        SDL.SDL_UpperBlit(self.screen, SDL.pointer(srcrect), self.screen, SDL.pointer(destrect))
+        return True
+    
     def draw_text(self, text, font, x=0, y=0, bold=False, italic=False, color=None, anchor_x='left', anchor_y='bottom'):
         if bold:
             text = "<b>%s</b>" % text
@@ -233,15 +345,8 @@ class SdlMainWindow(MainWindow):
     def draw_markup(self, markup, font, x=0, y=0, color=None, anchor_x='left', anchor_y='bottom', width=0):
         if color is None:
             color = (255, 255, 255, 255)
-        context = SDL_Pango.SDLPango_CreateContext()
-        SDL_Pango.SDLPango_SetDefaultColor(context, SDL_Pango.MATRIX_TRANSPARENT_BACK_WHITE_LETTER)
-        SDL_Pango.SDLPango_SetMinimumSize(context, width, 0)
-        markup = font.wrap_span(markup, color)
-        SDL_Pango.SDLPango_SetMarkup(context, markup, -1)
-        surface = SDL_Pango.SDLPango_CreateSurfaceDraw(context)
+        surface = self.text_cache.get(markup, font, color, width)
         self.blit_surface(surface, x, y, anchor_x, anchor_y)
-        SDL.SDL_FreeSurface(surface)
-        SDL_Pango.SDLPango_FreeContext(context)
     
     def draw_box(self, x, y, w, h, background_color=None, border_color=None):
         if background_color is None:
@@ -265,7 +370,7 @@ class SdlMainWindow(MainWindow):
     ########## Image functions
     
     def get_image(self, filename):
-        return SdlImage(filename)
+        return SdlImage(filename, self.surface_cache)
     
     def blit_surface(self, surface, x, y, anchor_x='left', anchor_y='bottom'):
         """Blit the entire image to the window with upper left corner at
@@ -295,11 +400,71 @@ class SdlMainWindow(MainWindow):
             surface = image.get_surface()
             self.blit_surface(surface, x, y)
             
-            # Free the memory used by the image and mark it as needing a reload
-            # if it's used again
+            # Drop the reference to the surface, which is owned by the
+            # surface cache
             image.free()
 
+class TextCache(object):
+    """LRU cache of rendered text surfaces keyed on the markup, font, color
+    and layout width, limited to both a number of entries and a total number
+    of bytes of pixel data.
+    
+    As with L{SurfaceCache}, the surfaces are owned by the cache and the
+    most recently rendered surface is never evicted.
+    """
+    def __init__(self, max_entries, budget):
+        self.max_entries = max_entries
+        self.budget = budget
+        self.size = 0
+        self.surfaces = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, markup, font, color, width):
+        key = (markup, font.get_spec(), tuple(color), width)
+        entry = self.surfaces.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            surface = font.render(markup, color, width)
+            nbytes = surface.contents.pitch * surface.contents.h
+            entry = (surface, nbytes)
+            self.size += nbytes
+        self.surfaces[key] = entry
+        self.evict()
+        return entry[0]
+    
+    def evict(self):
+        while len(self.surfaces) > 1 and (len(self.surfaces) > self.max_entries or self.size > self.budget):
+            key, (surface, nbytes) = self.surfaces.popitem(last=False)
+            SDL.SDL_FreeSurface(surface)
+            self.size -= nbytes
+    
+    def clear(self):
+        for surface, nbytes in self.surfaces.itervalues():
+            SDL.SDL_FreeSurface(surface)
+        self.surfaces.clear()
+        self.size = 0
+
+
 class SdlFontInfo(FontInfo):
+    context = None
+    
+    def get_context(self):
+        """Return the Pango context used to render all text in this font"""
+        if self.context is None:
+            self.context = SDL_Pango.SDLPango_CreateContext()
+            SDL_Pango.SDLPango_SetDefaultColor(self.context, SDL_Pango.MATRIX_TRANSPARENT_BACK_WHITE_LETTER)
+        return self.context
+    
+    def render(self, markup, color, width=0):
+        """Render the markup into a new surface that the caller must free"""
+        context = self.get_context()
+        SDL_Pango.SDLPango_SetMinimumSize(context, width, 0)
+        SDL_Pango.SDLPango_SetMarkup(context, self.wrap_span(markup, color), -1)
+        return SDL_Pango.SDLPango_CreateSurfaceDraw(context)
+    
     def calc_height(self):
         # I can't find a way to get font metrics out of SDL Pango, so create a
         # test string and see how tall it is.
@@ -320,17 +485,99 @@ class SdlFontInfo(FontInfo):
         markup = u"<span font='%s' foreground='%s'>%s</span>" % (spec, color, markup)
         return markup.encode('utf-8')
 
+class SurfaceCache(object):
+    """LRU cache of decoded image surfaces keyed on the filename, limited to
+    a total number of bytes of pixel data.
+    
+    The surfaces are owned by the cache and freed when they are evicted, so
+    users should only hold on to a surface while drawing it.  The most
+    recently loaded surface is never evicted, even if it alone exceeds the
+    budget.
+    
+    The file's modification time is only checked once every check_interval
+    seconds, so a cache hit doesn't touch the disk on every redraw.  A
+    surface is reloaded if the file has been replaced since it was loaded.
+    """
+    stats_interval = 500
+    
+    check_interval = 10.0
+    
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.surfaces = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get_mtime(self, filename):
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return None
+    
+    def get(self, filename):
+        now = time.time()
+        entry = self.surfaces.pop(filename, None)
+        if entry is not None and now >= entry[3]:
+            mtime = self.get_mtime(filename)
+            if mtime != entry[2]:
+                SDL.SDL_FreeSurface(entry[0])
+                self.size -= entry[1]
+                entry = None
+            else:
+                entry[3] = now + self.check_interval
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            mtime = self.get_mtime(filename)
+            surface = SDL_Image.IMG_Load(filename)
+            if not surface:
+                raise RuntimeError("Failed loading image %s: %s" % (filename, SDL_Image.IMG_GetError()))
+            nbytes = surface.contents.pitch * surface.contents.h
+            entry = [surface, nbytes, mtime, now + self.check_interval]
+            self.size += nbytes
+        self.surfaces[filename] = entry
+        self.evict()
+        if (self.hits + self.misses) % self.stats_interval == 0:
+            log.debug("surface cache: %s" % str(self.get_stats()))
+        return entry[0]
+    
+    def evict(self):
+        while self.size > self.budget and len(self.surfaces) > 1:
+            filename, entry = self.surfaces.popitem(last=False)
+            SDL.SDL_FreeSurface(entry[0])
+            self.size -= entry[1]
+            self.evictions += 1
+    
+    def clear(self):
+        for entry in self.surfaces.itervalues():
+            SDL.SDL_FreeSurface(entry[0])
+        self.surfaces.clear()
+        self.size = 0
+    
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'count': len(self.surfaces),
+            'bytes': self.size,
+            }
+
+
 class SdlImage(BaseImage):
-    def __init__(self, filename):
+    def __init__(self, filename, cache):
+        self.cache = cache
         BaseImage.__init__(self, filename)
         self.needs_reload = False
         
     def free(self):
-        """Free any system resources used by the image and prohibit further use
-        of the image unless reloaded.
+        """Release the image's surface and prohibit further use of the image
+        unless reloaded.  The surface itself is owned by the surface cache.
         
         """
-        SDL.SDL_FreeSurface(self.image)
         self.image = None
         self.needs_reload = True
     
@@ -344,12 +591,13 @@ class SdlImage(BaseImage):
         if not filename:
             return
         self.filename = filename
-        self.image = SDL_Image.IMG_Load(filename)
+        self.image = self.cache.get(filename)
         self.width = self.image.contents.w
         self.height = self.image.contents.h
         self.needs_reload = False
 
     def get_surface(self):
-        if self.needs_reload:
-            self.load(self.filename)
+        # Always go through the cache, because the surface that was loaded
+        # may have since been evicted
+        self.load(self.filename)
         return self.image
@@ -4,6 +4,7 @@ import pyinotify
 
 from task import Task, ProcessTask, TaskManager, ThreadTaskDispatcher, ProcessTaskDispatcher
 from download import BackgroundHttpDownloader
+import settings
 
 log = logging.getLogger("dinoteeth.updates")
 
@@ -26,17 +27,35 @@ class ThumbnailLoadTask(ProcessTask):
     def _failed_message(self):
         return "Failed creating thumbnail image for %s" % os.path.basename(self.imgpath)
 
+class MosaicCreateTask(ProcessTask):
+    def __init__(self, thumbnail_loader, key, size, placements):
+        ProcessTask.__init__(self)
+        self.thumbnail_loader = thumbnail_loader
+        self.key = key
+        self.size = size
+        self.placements = placements
+    
+    def __str__(self):
+        return "%s: mosaic=%s" % (self.__class__.__name__, self.key)
+    
+    def _start(self, dispatcher):
+        if self.thumbnail_loader.create_mosaic(self.key, self.size, self.placements) is None:
+            self.error = "Failed creating mosaic"
+    
+    def _failed_message(self):
+        return "Failed creating thumbnail mosaic"
+
 class UpdateManager(object):
     poster_thread = None
     
-    def __init__(self, event_callback, db, thumbnail_loader):
+    def __init__(self, event_callback, db, thumbnail_loader, timer_callback=None):
         cls = self.__class__
         if cls.poster_thread is not None:
             raise RuntimeError("UpdateManager already initialized")
         cls.event_callback = event_callback
         cls.db = db
         cls.thumbnails = thumbnail_loader
-        cls.task_manager = TaskManager(event_callback)
+        cls.task_manager = TaskManager(event_callback, timer_callback)
         dispatcher1 = ThreadTaskDispatcher()
         cls.task_manager.start_dispatcher(dispatcher1)
         dispatcher2 = ThreadTaskDispatcher(dispatcher1)
@@ -58,6 +77,11 @@ class UpdateManager(object):
         task = ThumbnailLoadTask(cls.thumbnails, imgpath)
         cls.task_manager.add_task(task)
     
+    @classmethod
+    def create_mosaic(cls, key, size, placements):
+        task = MosaicCreateTask(cls.thumbnails, key, size, placements)
+        cls.task_manager.add_task(task)
+    
     @classmethod
     def test(cls, num=4, delay=.5):
         for i in range(num):
@@ -65,12 +89,12 @@ class UpdateManager(object):
             cls.poster_thread.add_task(task)
     
     @classmethod
-    def start_ticks(cls, delay, expire_time):
-        cls.task_manager.start_ticks(delay, expire_time)
+    def schedule(cls, deadline, callback):
+        cls.task_manager.schedule(deadline, callback)
     
     @classmethod
-    def stop_ticks(cls):
-        cls.task_manager.stop_ticks()
+    def unschedule(cls, callback):
+        cls.task_manager.unschedule(callback)
     
     @classmethod
     def start_task(cls, task):
@@ -82,59 +106,134 @@ class UpdateManager(object):
         cls.process_tasks()
 
 
+class EventCoalescer(object):
+    """Collects filesystem events keyed by pathname and releases them only
+    after the pathname has been quiet for the settle time.
+    
+    Files being written only refresh their timestamp; they aren't reported
+    as added until a close after writing or a move into place has been
+    seen.  Only the most recent added/removed state of each pathname is
+    kept, so a burst of events produces a single change.
+    """
+    def __init__(self, settle_time):
+        self.settle_time = settle_time
+        
+        # pathname -> [time of last event, state] where the state is None
+        # while the file is still being written
+        self.pending = {}
+    
+    def __len__(self):
+        return len(self.pending)
+    
+    def update(self, pathname, state=None):
+        now = time.time()
+        entry = self.pending.get(pathname, None)
+        if entry is None:
+            self.pending[pathname] = [now, state]
+        else:
+            entry[0] = now
+            if state is not None:
+                entry[1] = state
+        
+        # Activity inside a new directory means it's still being filled
+        parent = os.path.dirname(pathname)
+        while parent in self.pending:
+            self.pending[parent][0] = now
+            parent = os.path.dirname(parent)
+    
+    def touch(self, pathname):
+        self.update(pathname)
+    
+    def add(self, pathname):
+        self.update(pathname, "added")
+    
+    def remove(self, pathname):
+        self.update(pathname, "removed")
+    
+    def pop_settled(self, now=None):
+        """Remove and return the pathnames that have been quiet for at least
+        the settle time
+        
+        Files that were written to but never closed are discarded.
+        
+        @returns: tuple of sets (added, removed)
+        """
+        if now is None:
+            now = time.time()
+        added = set()
+        removed = set()
+        for pathname, (last, state) in self.pending.items():
+            if now - last >= self.settle_time:
+                del self.pending[pathname]
+                if state == "added":
+                    added.add(pathname)
+                elif state == "removed":
+                    removed.add(pathname)
+        return added, removed
+
+
 class FileWatcher(pyinotify.ProcessEvent):
     def __init__(self, db, pevent=None, **kwargs):
         pyinotify.ProcessEvent.__init__(self, pevent=pevent, **kwargs)
         self.db = db
         self.media_path_dict = {}
         self.wm = pyinotify.WatchManager() # Watch Manager
-        self.added = set()
-        self.removed = set()
+        self.events = EventCoalescer(settings.update_settle_time)
     
     def add_path(self, path, flags):
         self.media_path_dict[path] = flags
     
-    def watch(self):
-        self.db.scan_and_update(self.media_path_dict)
+    def watch(self, full=False):
+        self.db.scan_and_update(self.media_path_dict, full=full)
         self.db.update_posters()
         mask = pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_CREATE
         notifier = pyinotify.Notifier(self.wm, self, timeout=5000)
         for path in self.media_path_dict.keys():
-            self.wm.add_watch(path, mask, rec=True)
+            self.wm.add_watch(path, mask, rec=True, auto_add=True)
+        next_batch = time.time()
         while True:
-            notifier.process_events()
-            while notifier.check_events():  #loop in case more events appear while we are processing
+            if notifier.check_events():
                 notifier.read_events()
                 notifier.process_events()
-            if len(self.added) + len(self.removed) > 0:
-                print "Found %d files added, %d removed" % (len(self.added), len(self.removed))
-                self.db.scan_and_update(self.media_path_dict)
-                self.added = set()
-                self.removed = set()
-            else:
-                print "no changes"
-            self.db.update_posters()
+            
+            # At most one update per settle period, no matter how many
+            # events are arriving
+            now = time.time()
+            if now < next_batch or len(self.events) == 0:
+                continue
+            added, removed = self.events.pop_settled(now)
+            if added or removed:
+                print "Found %d files added, %d removed" % (len(added), len(removed))
+                new_keys = self.db.update_files(added, removed, self.media_path_dict)
+                if new_keys:
+                    self.db.update_posters(new_keys)
+                next_batch = time.time() + self.events.settle_time
 
     def process_IN_CLOSE_WRITE(self, event):
 #        print "Modified (closed):", event.pathname
-        self.added.add(event.pathname)
+        self.events.add(event.pathname)
 
     def process_IN_DELETE(self, event):
 #        print "Removed (deleted):", event.pathname
-        self.removed.add(event.pathname)
+        self.events.remove(event.pathname)
 
     def process_IN_MODIFY(self, event):
 #        print "Modified:", event.pathname
-        self.added.add(event.pathname)
+        self.events.touch(event.pathname)
 
     def process_IN_MOVED_TO(self, event):
 #        print "Modified (moved to):", event.pathname
-        self.added.add(event.pathname)
+        self.events.add(event.pathname)
 
     def process_IN_MOVED_FROM(self, event):
 #        print "Removed (moved from):", event.pathname
-        self.removed.add(event.pathname)
+        self.events.remove(event.pathname)
 
     def process_IN_CREATE(self, event):
-#        print "Removed (deleted):", event.pathname
-        self.added.add(event.pathname)
+#        print "Created:", event.pathname
+        if event.dir:
+            # Directories don't get a close event, so they are added here
+            # and scanned once everything inside them has settled
+            self.events.add(event.pathname)
+        else:
+            self.events.touch(event.pathname)
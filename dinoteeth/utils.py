@@ -1,4 +1,4 @@
-import os, sys, time, glob, logging, re, shlex
+import os, sys, stat, time, logging, re, shlex
 from datetime import datetime, timedelta
 
 from persistent import Persistent
@@ -9,6 +9,16 @@ from ZEO import ClientStorage
 from ZODB import DB, FileStorage, POSException
 import transaction
 from persistent.mapping import PersistentMapping
+from BTrees.OOBTree import OOBTree
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        log.info("scandir not available; directory scans will stat every file")
+        scandir = None
 
 
 class DBFacade(object):
@@ -44,6 +54,19 @@ class DBFacade(object):
             self.dbroot[name].clear()
         return self.dbroot[name]
     
+    def get_btree(self, name, clear=False):
+        """Like get_mapping, but backed by an OOBTree so that large indexes
+        are stored in separate buckets rather than as a single pickle.
+        """
+        if name not in self.dbroot:
+            self.dbroot[name] = OOBTree()
+        if clear:
+            self.dbroot[name].clear()
+        return self.dbroot[name]
+    
+    def exists(self, name):
+        return name in self.dbroot
+    
     def get_value(self, name, initial):
         if name not in self.dbroot:
             self.dbroot[name] = initial
@@ -55,24 +78,51 @@ class DBFacade(object):
     def add(self, name, obj):
         self.dbroot[name] = obj
     
+    # Incremented whenever the database may have changed, so that cached
+    # results can tell if they are stale
+    generation = 0
+    
+    # (attribute, id) pairs describing the changes in the current
+    # transaction, passed to the commit callbacks.  An empty set means that
+    # the changes are unknown and anything may have changed.
+    changes = set()
+    
     callbacks = []
     @classmethod
     def add_commit_callback(cls, callback):
         cls.callbacks.append(callback)
+    
+    @classmethod
+    def mark_changed(cls, attr, id):
+        """Describe a change made in the current transaction so that commit
+        callbacks can limit their work to the affected objects.
+        
+        @param attr: name of the changed attribute, e.g. "starred", or
+        "title_key" or "metadata" when media files are added to, removed from
+        or moved between titles
+        @param id: metadata id of the changed object, or the title key for
+        "title_key"
+        """
+        cls.changes.add((attr, id))
         
     @classmethod
     def commit(cls):
         transaction.commit()
+        DBFacade.generation += 1
+        changes = DBFacade.changes
+        DBFacade.changes = set()
         for callback in cls.callbacks:
-            callback()
+            callback(changes)
     
     @classmethod
     def rollback(cls):
         transaction.rollback()
+        DBFacade.changes = set()
     
     @classmethod
     def abort(cls):
         transaction.abort()
+        DBFacade.changes = set()
     
     def get_last_modified(self):
         return self.get_value("last_modified", -1)
@@ -81,7 +131,20 @@ class DBFacade(object):
         self.set_value("last_modified", time.time())
     
     def sync(self):
+        last_modified = self.get_last_modified()
         self.connection.sync()
+        if self.get_last_modified() != last_modified:
+            # Changes committed by another client (usually the update
+            # monitor) aren't described, so the callbacks see an empty set
+            DBFacade.generation += 1
+            for callback in self.callbacks:
+                callback(set())
+    
+    def cache_gc(self):
+        """Ghost unmodified objects in the connection's cache to keep memory
+        usage bounded during long running operations.
+        """
+        self.connection.cacheGC()
     
     def pack(self):
         self.db.pack()
@@ -267,6 +330,18 @@ class TitleKey(Persistent):
 def decode_title_text(text):
     return text.replace('_n_',' & ').replace('-s_','\'s ').replace('-t_','\'t ').replace('-m_','\'m ').replace('.._',': ').replace('.,_','; ').replace('_',' ')
 
+def sort_title(title, ignore_leading_articles):
+    """Return a lower case version of the title suitable for sorting, with
+    any leading article moved to the end (e.g. "the thing" -> "thing, the")
+    """
+    t = title.lower()
+    for article in ignore_leading_articles:
+        a = "%s " % article.lower()
+        if t.startswith(a):
+            t = t[len(a):] + ", %s" % t[0:len(article)]
+            break
+    return t
+
 def encode_title_text(text):
     return text.replace(' & ','_n_').replace('\'s ','-s_').replace('\'t ','-t_').replace('\'m ','-m_').replace(': ','.._').replace('; ','.,_').replace(' ','_')
 
@@ -404,38 +479,140 @@ def find_next_episode_number(title, season=-1, episode_char='e', filename="", me
                     largest = num
     return largest + 1
 
-def iter_dir(path, valid_extensions=None, exclude=None, verbose=False, recurse=False):
-    if exclude is not None:
+class ListdirEntry(object):
+    """Minimal stand-in for the scandir DirEntry object used when scandir
+    isn't available.
+    """
+    def __init__(self, path, name):
+        self.name = name
+        self.path = os.path.join(path, name)
+        self.stat_result = None
+    
+    def stat(self):
+        if self.stat_result is None:
+            self.stat_result = os.stat(self.path)
+        return self.stat_result
+    
+    def is_dir(self):
         try:
-            exclude = re.compile(exclude)
-        except:
-            log.warning("Invalid regular expression %s" % exclude)
-            pass
-    videos = glob.glob(os.path.join(path, "*"))
-    for video in videos:
-        valid = False
-        if os.path.isdir(video):
-            if not video.endswith(".old"):
-                if exclude:
-                    match = cls.exclude.search(video)
-                    if match:
-                        log.debug("Skipping dir %s" % video)
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+    
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+def iter_dir_entries(path):
+    """Generator returning DirEntry objects for the contents of a single
+    directory, skipping hidden entries (names starting with ".") like the
+    glob("*") that was used previously.
+    
+    When scandir is available, entries are read from the directory as they
+    are needed rather than building a list of the entire directory.
+    """
+    try:
+        if scandir is not None:
+            entries = scandir(path)
+        else:
+            entries = [ListdirEntry(path, name) for name in os.listdir(path)]
+    except OSError, e:
+        log.warning("Can't read directory %s: %s" % (path, e))
+        return
+    for entry in entries:
+        if not entry.name.startswith("."):
+            yield entry
+
+def iter_subdirs(path):
+    """Generator returning the pathnames of the subdirectories of path
+    """
+    for entry in iter_dir_entries(path):
+        if entry.is_dir():
+            yield entry.path
+
+def compile_exclude(exclude):
+    """Return a list of compiled regular expressions from a string or list
+    of strings, skipping any invalid expressions
+    """
+    if not exclude:
+        return []
+    if isinstance(exclude, basestring):
+        exclude = [exclude]
+    regexes = []
+    for text in exclude:
+        try:
+            regexes.append(re.compile(text))
+        except re.error:
+            log.warning("Invalid regular expression %s" % text)
+    return regexes
+
+def walk_dir(path, valid_extensions=None, exclude=None, recurse=False):
+    """Generator returning DirEntry objects for the files in the directory,
+    optionally descending into subdirectories.
+    
+    Subdirectories ending in ".old" or matching one of the exclude regular
+    expressions are skipped entirely.  Directories are visited depth first
+    but each directory's files are returned before descending, so only the
+    pathnames of the pending subdirectories are held in memory.
+    
+    @param valid_extensions: list of filename suffixes to match, or None to
+    return all files
+    @param exclude: regular expression or list of regular expressions
+    matched against subdirectory pathnames
+    """
+    if valid_extensions:
+        suffixes = tuple(valid_extensions)
+    else:
+        suffixes = None
+    exclude = compile_exclude(exclude)
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        subdirs = []
+        for entry in iter_dir_entries(dirpath):
+            try:
+                if entry.is_dir():
+                    if not recurse or entry.name.endswith(".old"):
                         continue
-                log.debug("Checking dir %s" % video)
-                if recurse:
-                    iter_dir(video, valid_extensions, exclude, verbose, True)
-        elif os.path.isfile(video):
-            log.debug("Checking %s" % video)
-            if valid_extensions:
-                for ext in valid_extensions:
-                    if video.endswith(ext):
-                        valid = True
-                        log.debug("Found valid media: %s" % video)
-                        break
-            else:
-                valid = True
-            if valid:
-                yield video
+                    for regex in exclude:
+                        if regex.search(entry.path):
+                            log.debug("Skipping dir %s" % entry.path)
+                            break
+                    else:
+                        subdirs.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if suffixes is None or entry.path.endswith(suffixes):
+                yield entry
+        # Reversed so that the subdirectories are processed in directory order
+        subdirs.reverse()
+        stack.extend(subdirs)
+
+def iter_dir(path, valid_extensions=None, exclude=None, verbose=False, recurse=False):
+    """Generator returning the pathnames of files in the directory
+    
+    See L{walk_dir} for a description of the arguments.
+    """
+    for entry in walk_dir(path, valid_extensions, exclude, recurse):
+        yield entry.path
+
+def iter_dir_stat(path, valid_extensions=None, exclude=None, recurse=False):
+    """Generator returning (pathname, stat_result) tuples for the files in
+    the directory, using a single stat call per file.
+    
+    See L{walk_dir} for a description of the arguments.
+    """
+    for entry in walk_dir(path, valid_extensions, exclude, recurse):
+        try:
+            stat_result = entry.stat()
+        except OSError:
+            continue
+        yield entry.path, stat_result
 
 def parse_int_string(nputstr=""):
     """Return list of integers from comma separated ranges
@@ -2,6 +2,7 @@ import os, sys, glob, time, random, Queue
 
 from controller import *
 from metadata import MetadataLoader
+from utils import DBFacade
 
 class MenuEmptyError(RuntimeError):
     pass
@@ -15,6 +16,7 @@ class AbstractLayout(object):
         self.hierarchy = []
         self.stack = []
         self.controller = None
+        self.changed = set(["all"])
     
     def compute_params(self, margins):
         """Compute layout size
@@ -65,6 +67,15 @@ class AbstractLayout(object):
     def get_controller(self):
         return self.controller
     
+    def mark_changed(self, *names):
+        """Force the named parts of the layout to be redrawn on the next
+        draw, regardless of whether their state appears to have changed.
+        
+        @param names: renderer names (e.g. "detail"), or "all" to redraw the
+        entire screen
+        """
+        self.changed.update(names)
+    
     def refresh(self):
         self.refresh_menu()
     
@@ -106,22 +117,54 @@ class MenuDetail2ColumnLayout(AbstractLayout):
         self.footer_box = (-1, -1, self.width + 2, footer_h + y)
     
     def draw(self):
-        self.window.clear_draw_iterator()
-        self.title_renderer.draw(self.hierarchy)
+        """Redraw only the renderers whose state has changed since the last
+        draw, marking their boxes as dirty so the window only has to update
+        those parts of the screen.
+        """
+        changed = self.changed
+        self.changed = set()
+        full = "all" in changed
+        if full:
+            self.window.mark_all_dirty()
+        if self.title_renderer.is_changed(self.hierarchy) or full:
+            self.title_renderer.draw(self.hierarchy)
+            self.title_renderer.mark_dirty()
         while True:
             try:
                 menu = self.get_menu()
-                self.menu_renderer.draw(menu)
-                self.detail_renderer.draw(menu)
-                self.status_renderer.draw()
+                old_state = self.menu_renderer.last_state
+                if full:
+                    self.menu_renderer.is_changed(menu)
+                    self.menu_renderer.draw(menu)
+                    self.menu_renderer.mark_dirty()
+                elif self.menu_renderer.is_changed(menu):
+                    self.menu_renderer.redraw(old_state, menu)
+                status_changed = self.status_renderer.is_changed()
+                if self.detail_renderer.is_changed(menu) or full or "detail" in changed:
+                    self.window.clear_draw_iterator()
+                    self.detail_renderer.draw(menu)
+                    self.status_renderer.draw()
+                    self.detail_renderer.mark_dirty()
+                elif status_changed:
+                    # The status box is translucent and drawn over the detail,
+                    # so the detail underneath it has to be restored first
+                    self.status_renderer.clip()
+                    self.detail_renderer.draw(menu)
+                    self.status_renderer.unclip()
+                    self.status_renderer.draw()
+                    self.status_renderer.mark_dirty()
                 break
             except MenuEmptyError:
                 if self.select_parent_menu():
                     break
-        self.footer_renderer.draw(self.controller)
+        if self.footer_renderer.is_changed(self.controller) or full:
+            self.footer_renderer.draw(self.controller)
+            self.footer_renderer.mark_dirty()
 
 
 class Renderer(object):
+    last_state = None
+    
     def __init__(self, window, box, conf):
         self.window = window
         self.x = box[0]
@@ -141,6 +184,34 @@ class Renderer(object):
     
     def clear(self):
         self.window.clear_rect(self.x, self.y, self.w, self.h)
+    
+    def mark_dirty(self):
+        self.window.mark_dirty(self.x, self.y, self.w, self.h)
+    
+    def get_state(self, *args):
+        """Return a value that compares equal as long as the renderer would
+        draw the same thing, given the same arguments as draw.
+        """
+        return None
+    
+    def is_changed(self, *args):
+        """Check if the renderer needs to be redrawn since the last call,
+        remembering the new state.
+        """
+        state = self.get_state(*args)
+        changed = state != self.last_state
+        self.last_state = state
+        return changed
+    
+    def redraw(self, old_state, *args):
+        """Update the renderer's box from what was drawn for old_state to
+        the current state, marking the changed regions as dirty.
+        
+        The default is to draw the entire box; subclasses can limit the
+        drawing to the parts that actually changed.
+        """
+        self.draw(*args)
+        self.mark_dirty()
 
 
 class MenuRenderer(Renderer):
@@ -187,11 +258,115 @@ class VerticalMenuRenderer(MenuRenderer):
                                   x=x, y=y,
                                   anchor_x='left', anchor_y='center')
     
+    def get_visible_range(self, menu):
+        return (max(0, menu.cursor - self.items_in_half),
+                min(menu.num_items() - 1, menu.cursor + self.items_in_half))
+    
+    def get_row(self, offset):
+        """Return the y coordinate of the center of the row at the given
+        offset from the cursor, along with the bottom and top of the row.
+        """
+        selected_h = self.window.selected_font.height
+        h = self.window.font.height
+        if offset == 0:
+            y = self.center
+            h = selected_h
+        elif offset < 0:
+            y = self.center + selected_h + (-offset - 1) * h
+        else:
+            y = self.center - selected_h - (offset - 1) * h
+        bottom = y - h/2
+        return y, bottom, bottom + h
+    
+    def get_state(self, menu):
+        try:
+            menu.get_selected_item()
+        except IndexError:
+            raise MenuEmptyError
+        first, last = self.get_visible_range(menu)
+        items = []
+        for i in range(first, last + 1):
+            item = menu.get_item(i)
+            items.append((item.title, item.enabled, item.is_toggle() and item.state))
+        return (id(menu), menu.cursor, first, items)
+    
+    def redraw(self, old_state, menu):
+        """Scroll the rows that are still visible into their new positions
+        and only draw the rows that have changed, i.e.  the rows of the old
+        and new cursor positions, the rows between them, any rows whose
+        contents are different and the rows scrolled into view.
+        """
+        state = self.last_state
+        if old_state is None or old_state[0] != state[0]:
+            return MenuRenderer.redraw(self, old_state, menu)
+        old_cursor, old_first, old_items = old_state[1:]
+        cursor, first, items = state[1:]
+        delta = cursor - old_cursor
+        if abs(delta) >= self.items_in_half:
+            return MenuRenderer.redraw(self, old_state, menu)
+        
+        # Moving the cursor down the list moves the rows up the screen
+        shift = delta * self.window.font.height
+        if not self.window.scroll_rect(self.x, self.y, self.w, self.h, shift):
+            return MenuRenderer.redraw(self, old_state, menu)
+        
+        # Find the (bottom, top) spans that no longer show the right thing:
+        # the part of the box uncovered by the scroll, rows scrolled into
+        # place that don't match the new row at that position, and new rows
+        # that weren't drawn in the right place before.
+        spans = []
+        if shift > 0:
+            spans.append((self.y, self.y + shift))
+        elif shift < 0:
+            spans.append((self.y + self.h + shift, self.y + self.h))
+        valid = set()
+        for j, old_item in enumerate(old_items):
+            i = old_first + j
+            y, bottom, top = self.get_row(i - old_cursor)
+            bottom += shift
+            top += shift
+            if (first <= i < first + len(items) and
+                    items[i - first] == old_item and
+                    (i == cursor) == (i == old_cursor) and
+                    self.get_row(i - cursor)[1:] == (bottom, top)):
+                valid.add(i)
+            else:
+                spans.append((bottom, top))
+        for j in range(len(items)):
+            i = first + j
+            if i not in valid:
+                spans.append(self.get_row(i - cursor)[1:])
+        
+        # Clear the spans, then draw every row that overlaps a cleared span
+        self.clip()
+        for bottom, top in spans:
+            self.window.clear_rect(self.x, bottom, self.w, top - bottom)
+        for j in range(len(items)):
+            i = first + j
+            y, bottom, top = self.get_row(i - cursor)
+            for b, t in spans:
+                if bottom < t and top > b:
+                    self.draw_item(menu.get_item(i), y, i == cursor)
+                    break
+        self.unclip()
+        if delta != 0:
+            menu.get_selected_item().do_on_selected_item()
+        
+        if shift != 0:
+            self.mark_dirty()
+        else:
+            for bottom, top in spans:
+                bottom = max(bottom, self.y)
+                top = min(top, self.y + self.h)
+                if top > bottom:
+                    self.window.mark_dirty(self.x, bottom, self.w, top - bottom)
+    
     def draw(self, menu):
         try:
             item = menu.get_selected_item()
         except IndexError:
             raise MenuEmptyError
+        first, last = self.get_visible_range(menu)
         self.clear()
         self.clip()
         self.draw_item(item, self.center, True)
@@ -199,8 +374,7 @@ class VerticalMenuRenderer(MenuRenderer):
         
         y = self.center + self.window.selected_font.height
         i = menu.cursor - 1
-        limit = max(0, menu.cursor - self.items_in_half)
-        while i >= limit:
+        while i >= first:
             item = menu.get_item(i)
             self.draw_item(item, y, False)
             y += self.window.font.height
@@ -208,8 +382,7 @@ class VerticalMenuRenderer(MenuRenderer):
             
         y = self.center - self.window.selected_font.height
         i = menu.cursor + 1
-        limit = min(menu.num_items() - 1, menu.cursor + self.items_in_half)
-        while i <= limit:
+        while i <= last:
             item = menu.get_item(i)
             self.draw_item(item, y, False)
             y -= self.window.font.height
@@ -218,6 +391,9 @@ class VerticalMenuRenderer(MenuRenderer):
 
 
 class TitleRenderer(Renderer):
+    def get_state(self, hierarchy):
+        return [menu.title for menu in hierarchy]
+    
     def draw(self, hierarchy):
         self.clear()
         title = []
@@ -231,6 +407,15 @@ class TitleRenderer(Renderer):
 
 
 class DetailRenderer(Renderer):
+    def get_state(self, menu):
+        # The metadata of the selected item may change when the database
+        # does, so the generation is part of the state
+        try:
+            item = menu.get_selected_item()
+        except IndexError:
+            raise MenuEmptyError
+        return (id(menu), menu.cursor, id(item), DBFacade.generation)
+    
     def draw(self, menu):
         item = menu.get_selected_item()
         m = item.get_metadata(self)
@@ -327,7 +512,10 @@ class SimpleStatusRenderer(StatusRenderer):
         self.expire_time = time.time()
         self.display_interval = 5
     
-    def draw(self):
+    def get_state(self):
+        """Pull any new status updates off the queue and return the status
+        text currently being displayed, or None if the status box is hidden.
+        """
         found = False
         while True:
             try:
@@ -347,11 +535,16 @@ class SimpleStatusRenderer(StatusRenderer):
         else:
             # No items found means that the countdown timer is left as-is
             if self.last_item is None:
-                return
+                return None
             
         if time.time() > self.expire_time:
             # If the countdown timer has expired, no drawing takes place
             self.window.unschedule(self.window.on_status_change)
+            return None
+        return (self.last_item, self.expire_time)
+    
+    def draw(self):
+        if self.last_state is None:
             return
         #print "status drawing! (%d,%d) %s" % (self.x, self.y, self.last_item)
         self.window.draw_box(self.x, self.y, self.w, self.h,
@@ -362,6 +555,9 @@ class SimpleStatusRenderer(StatusRenderer):
                                   anchor_x='left', anchor_y='center')
 
 class FooterRenderer(Renderer):
+    def get_state(self, controller):
+        return controller.get_markup()
+    
     def draw(self, controller):
         self.clear()
         text = controller.get_markup()
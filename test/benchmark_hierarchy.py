@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the menu hierarchy against synthetic libraries of various sizes.
+
+A ZODB library of movies and TV series is generated for each size using
+the real scan and metadata classes (no network lookups), and the populators
+in hierarchy.py are timed both cold (right after a commit, when all the
+per-generation caches are stale) and warm.  Results are written as JSON so
+that runs can be compared to catch regressions.
+
+Usage: python benchmark_hierarchy.py [-o results.json] [-s 1000,10000,50000]
+"""
+
+import os, sys, time, random, shutil, tempfile, json, platform
+from datetime import datetime
+from optparse import OptionParser
+
+from dinoteeth_test import *
+
+import dinoteeth.home_theater
+from dinoteeth.filescan import MediaFile
+from dinoteeth.database import HomeTheaterDatabase
+from dinoteeth.home_theater.metadata import FakeMovieMetadata, FakeSeriesMetadata, Person, Company
+from dinoteeth.model import MenuItem
+from dinoteeth.hierarchy import *
+from dinoteeth.utils import DBFacade
+
+
+class PersonInfo(dict):
+    """Minimal stand-in for the IMDb person object used to create a Person"""
+    def __init__(self, id, name):
+        dict.__init__(self)
+        self.personID = id
+        self['canonical name'] = name
+
+
+class BenchmarkConfig(object):
+    """The only part of the application config used by the populators"""
+    def __init__(self, db):
+        self.db = db
+
+
+genres = [u"Action", u"Adventure", u"Animation", u"Comedy", u"Crime",
+          u"Documentary", u"Drama", u"Family", u"Fantasy", u"Horror",
+          u"Mystery", u"Romance", u"Sci-Fi", u"Thriller", u"Western"]
+certificates = [u"G", u"PG", u"PG-13", u"R", u"TV-14", u"TV-MA"]
+words = [u"The", u"Red", u"Night", u"Last", u"River", u"Empire", u"Storm",
+         u"Secret", u"City", u"Garden", u"Shadow", u"Winter", u"Return",
+         u"Island", u"Machine", u"Silver", u"Hunt", u"October", u"Dawn"]
+
+
+def summary_of(guess, length):
+    return {
+        'video': [],
+        'audio': [],
+        'subtitles': [],
+        'length': length,
+        'guess': guess,
+        }
+
+def make_title(rand, i):
+    return u"%s %s %d" % (rand.choice(words), rand.choice(words), i)
+
+def add_credits(rand, metadata, people, companies):
+    metadata.genres = rand.sample(genres, 2)
+    metadata.certificate = rand.choice(certificates)
+    metadata.directors = [rand.choice(people)]
+    metadata.cast = rand.sample(people, 8)
+    metadata.companies = [rand.choice(companies)]
+
+def add_metadata(db, metadata, scans):
+    for item in scans:
+        item.metadata = metadata
+    metadata.update_with_media_files(scans)
+    metadata.merge_database_objects(db)
+    db.title_key_to_metadata[scans[0].scan.title_key] = metadata
+    db.index_metadata(metadata)
+    for item in scans:
+        db.index_play_date(item)
+
+def create_library(path, num_files, seed=1234):
+    """Create a database of num_files media files, about 60% movies and the
+    rest episodes of series with two seasons of ten episodes each.
+    """
+    rand = random.Random(seed)
+    zodb = DBFacade(path)
+    db = HomeTheaterDatabase(zodb)
+    people = [Person(PersonInfo("%07d" % i, u"Surname%d, Name%d" % (i, i))) for i in range(max(50, num_files / 5))]
+    companies = [Company(None, "co%07d" % i, u"Company %d" % i) for i in range(max(10, num_files / 100))]
+    now = time.time()
+    num_movies = num_files * 6 / 10
+    count = 0
+
+    def add_files(flags, guesses, length):
+        scans = []
+        for pathname, guess in guesses:
+            mtime = int(now - rand.random() * 2 * 365 * 24 * 3600)
+            media_file = db.add(pathname, flags, ((mtime, length, len(db.scans)), "MEDIA_AV", summary_of(guess, length)))
+            if rand.random() < 0.2:
+                media_file.scan.play_date = datetime.utcfromtimestamp(mtime + 3600)
+                media_file.scan.position = length / 2
+            scans.append(media_file)
+        return scans
+
+    for i in range(num_movies):
+        title = make_title(rand, i)
+        guess = {'type': 'movie', 'title': title}
+        scans = add_files("movies", [("/media/movies/%d.mkv" % i, guess)], 6000)
+        metadata = FakeMovieMetadata("tt%07d" % i, scans[0].scan.title_key, scans)
+        add_credits(rand, metadata, people, companies)
+        add_metadata(db, metadata, scans)
+        count += 1
+        if count % 1000 == 0:
+            zodb.commit()
+            zodb.cache_gc()
+
+    i = num_movies
+    while count < num_files:
+        series = make_title(rand, i)
+        guesses = []
+        for season in [1, 2]:
+            for episode in range(1, 11):
+                guess = {'type': 'episode', 'series': series, 'season': season, 'episodeNumber': episode}
+                guesses.append(("/media/series/%d-s%02de%02d.mkv" % (i, season, episode), guess))
+        scans = add_files("series", guesses[:num_files - count], 1800)
+        metadata = FakeSeriesMetadata("tt%07d" % i, scans[0].scan.title_key, scans)
+        add_credits(rand, metadata, people, companies)
+        add_metadata(db, metadata, scans)
+        count += len(scans)
+        i += 1
+        if count % 1000 < 20:
+            zodb.commit()
+            zodb.cache_gc()
+    zodb.commit()
+    return db
+
+
+def populate(populator, rows=20):
+    """Populate a menu and create the first page of menu items, like the
+    first draw of the menu
+    """
+    menu = MenuItem("benchmark", populate_children=populator)
+    num = menu.num_items()
+    for i in range(min(rows, num)):
+        item = menu.get_item(i)
+        item.get_metadata(None)
+    return menu
+
+def invalidate():
+    # Simulate a commit so all the per-generation caches are stale
+    DBFacade.generation += 1
+    MenuItem.refresh_all()
+
+def measure(func, repeat=3):
+    """Return the best cold and warm times of func in milliseconds"""
+    cold = warm = None
+    for i in range(repeat):
+        invalidate()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if cold is None or elapsed < cold:
+            cold = elapsed
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if warm is None or elapsed < warm:
+            warm = elapsed
+    return {'cold_ms': cold * 1000, 'warm_ms': warm * 1000}
+
+
+def run_benchmarks(db, repeat=3, samples=50, seed=1234):
+    rand = random.Random(seed)
+    config = BenchmarkConfig(db)
+    root = RootPopulator(config)
+    top = TopLevelVideos(root, config)
+    movies = [m for m in db.metadata.itervalues() if m.media_subcategory == "movie"]
+    series = [m for m in db.metadata.itervalues() if m.media_subcategory == "series"]
+    movies = rand.sample(movies, min(samples, len(movies)))
+    series = rand.sample(series, min(samples, len(series)))
+
+    def top_level():
+        menu = populate(top)
+        populate(menu.get_item(0).populate_children)
+
+    def credit_lookup(credit):
+        def func():
+            menu = populate(CreditLookup(top, config, credit))
+            if menu.num_items() > 0:
+                populate(menu.get_item(0).populate_children)
+        return func
+
+    def search():
+        populator = SearchPopulator(top, config, "")
+        menu = populate(populator)
+        text = ""
+        for c in "the red":
+            text += c
+            populator.set_search_text(text)
+            menu.invalidate()
+            menu.num_items()
+            for i in range(min(20, menu.num_items())):
+                menu.get_item(i)
+
+    def recently_added():
+        populate(DateLookup(top, config, index="date_added", limit=100))
+
+    def recently_played():
+        populate(DateLookup(top, config, filter=lambda f: f.scan.play_date is not None, time_lookup=play_date, index="play_date", limit=100))
+
+    def date_ranges():
+        menu = populate(IndexedDateLookup(top, config))
+        for i in range(menu.num_items()):
+            populate(menu.get_item(i).populate_children)
+
+    def movie_top_level():
+        for m in movies:
+            populate(MovieTopLevel(top, config, m))
+
+    def series_episodes():
+        for m in series:
+            populate(SeriesEpisodes(top, config, m, 1))
+
+    benchmarks = [
+        ("top_level_videos", top_level),
+        ("credit_lookup_genres", credit_lookup("genres")),
+        ("credit_lookup_cast", credit_lookup("cast")),
+        ("search_keystrokes", search),
+        ("date_lookup_recently_added", recently_added),
+        ("date_lookup_recently_played", recently_played),
+        ("indexed_date_lookup", date_ranges),
+        ("movie_top_level", movie_top_level),
+        ("series_episodes", series_episodes),
+        ]
+    results = {}
+    for name, func in benchmarks:
+        results[name] = measure(func, repeat)
+        print >> sys.stderr, "  %-30s cold %10.2f ms  warm %10.2f ms" % (name, results[name]['cold_ms'], results[name]['warm_ms'])
+    return results
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--sizes", action="store", dest="sizes", default="1000,10000,50000", help="Comma separated list of library sizes")
+    parser.add_option("-r", "--repeat", action="store", type="int", dest="repeat", default=3)
+    parser.add_option("-o", "--output", action="store", dest="output", default=None, help="Write JSON results to this file rather than stdout")
+    parser.add_option("-d", "--dir", action="store", dest="dir", default=None, help="Directory for the generated databases (default: temporary directory)")
+    parser.add_option("-k", "--keep", action="store_true", dest="keep", default=False, help="Keep the generated databases")
+    (options, args) = parser.parse_args()
+
+    workdir = options.dir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="dinoteeth-benchmark-")
+    elif not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'repeat': options.repeat,
+        'libraries': {},
+        }
+    try:
+        for size in [int(s) for s in options.sizes.split(",")]:
+            path = os.path.join(workdir, "library-%d.fs" % size)
+            print >> sys.stderr, "Creating library of %d media files" % size
+            start = time.time()
+            if os.path.exists(path):
+                db = HomeTheaterDatabase(DBFacade(path))
+            else:
+                db = create_library(path, size)
+            created = time.time() - start
+            print >> sys.stderr, "Benchmarking library of %d media files" % size
+            output['libraries'][str(size)] = {
+                'media_files': len(db.scans),
+                'metadata': len(db.metadata),
+                'create_s': created,
+                'results': run_benchmarks(db, options.repeat),
+                }
+            db.zodb.close()
+    finally:
+        if not options.keep and options.dir is None:
+            shutil.rmtree(workdir)
+
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as fh:
+            fh.write(text + "\n")
+    else:
+        print text
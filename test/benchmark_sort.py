@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the old comparison based sorting of media files, which rebuilt
+the sort key on both sides of every comparison, to sorting using the
+cached sort keys.
+
+Usage: python benchmark_sort.py [num_episodes [num_series]]
+"""
+
+import sys, time, random
+
+from dinoteeth_test import *
+
+import dinoteeth.home_theater
+from dinoteeth.filescan import MediaFile
+from dinoteeth.database import StaticFileList
+
+def make_episodes(num_episodes, num_series):
+    files = StaticFileList()
+    for i in range(num_episodes):
+        series = "The Series %d" % (i % num_series)
+        season = (i / num_series) % 10 + 1
+        episode = i / (num_series * 10) + 1
+        summary = {
+            'video': [],
+            'audio': [],
+            'subtitles': [],
+            'length': 1800,
+            'guess': {
+                'type': 'episode',
+                'series': series,
+                'season': season,
+                'episodeNumber': episode,
+                },
+            }
+        pathname = "%s-s%02de%02d.mkv" % (series.replace(" ", "_"), season, episode)
+        files.append(MediaFile(pathname, "series", probed=((0, 0, i), "MEDIA_AV", summary)))
+    random.shuffle(files)
+    return files
+
+def uncached_cmp(a, b):
+    return cmp(a.scan.calc_sort_key(), b.scan.calc_sort_key())
+
+def timeit(label, func, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-30s %8.2f ms" % (label, best * 1000)
+    return best
+
+if __name__ == "__main__":
+    num_episodes = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    num_series = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    files = make_episodes(num_episodes, num_series)
+    print "Sorting %d episodes from %d series" % (num_episodes, num_series)
+
+    old = timeit("compare with sort_key rebuilt", lambda: sorted(files, cmp=uncached_cmp))
+    new = timeit("cached key", lambda: StaticFileList(files).sort())
+    assert [f.pathname for f in sorted(files, cmp=uncached_cmp)] == [f.pathname for f in sorted(files, key=MediaFile.sort_key)]
+    print "speedup: %.1fx" % (old / new)
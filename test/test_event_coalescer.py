@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+from dinoteeth_test import *
+
+from dinoteeth.updates import EventCoalescer
+
+class TestEventCoalescer(TestCase):
+    def setUp(self):
+        self.events = EventCoalescer(2.0)
+        self.later = time.time() + 10
+
+    def testMerge(self):
+        self.events.touch("/media/a.mkv")
+        self.events.touch("/media/a.mkv")
+        self.events.add("/media/a.mkv")
+        self.events.add("/media/b.mkv")
+        self.events.remove("/media/b.mkv")
+        self.events.remove("/media/c.mkv")
+        self.events.add("/media/c.mkv")
+        self.assertEqual(len(self.events), 3)
+        added, removed = self.events.pop_settled(self.later)
+        self.assertEqual(added, set(["/media/a.mkv", "/media/c.mkv"]))
+        self.assertEqual(removed, set(["/media/b.mkv"]))
+        self.assertEqual(len(self.events), 0)
+
+    def testTouchKeepsState(self):
+        self.events.add("/media/a.mkv")
+        self.events.touch("/media/a.mkv")
+        added, removed = self.events.pop_settled(self.later)
+        self.assertEqual(added, set(["/media/a.mkv"]))
+
+    def testUnclosedDiscarded(self):
+        self.events.touch("/media/partial.mkv")
+        added, removed = self.events.pop_settled(self.later)
+        self.assertEqual((added, removed), (set(), set()))
+        self.assertEqual(len(self.events), 0)
+
+    def testSettleTime(self):
+        self.events.add("/media/a.mkv")
+        added, removed = self.events.pop_settled(time.time() + 1.0)
+        self.assertEqual(added, set())
+        self.assertEqual(len(self.events), 1)
+        added, removed = self.events.pop_settled(time.time() + 2.5)
+        self.assertEqual(added, set(["/media/a.mkv"]))
+
+    def testParentDirectoryRefreshed(self):
+        self.events.add("/media/new")
+        self.events.pending["/media/new"][0] -= 5
+        self.events.add("/media/new/a.mkv")
+        added, removed = self.events.pop_settled(time.time() + 1.0)
+        self.assertEqual(added, set())
+        added, removed = self.events.pop_settled(time.time() + 2.5)
+        self.assertEqual(added, set(["/media/new", "/media/new/a.mkv"]))
+
+
+if __name__ == '__main__':
+    test_all()
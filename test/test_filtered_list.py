@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from dinoteeth_test import *
+
+from dinoteeth.database import FilteredFileList
+
+class Item(object):
+    def __init__(self, n):
+        self.n = n
+        self.metadata = n % 3
+
+class TestFilteredFileList(TestCase):
+    def setUp(self):
+        self.base = FilteredFileList()
+        self.base.extend([Item(i) for i in range(10)])
+        self.filtered = self.base.filter(lambda f: f.n % 2).filter(lambda f: f.n > 4)
+
+    def numbers(self, items):
+        return [f.n for f in items]
+
+    def testChain(self):
+        self.assertEqual(self.numbers(self.filtered), [5, 7, 9])
+        self.assertEqual(len(self.filtered), 3)
+        unique, scans_in_each = self.filtered.get_unique_metadata()
+        self.assertEqual(unique, set([0, 1, 2]))
+
+    def testBaseChanged(self):
+        self.assertEqual(len(self.filtered), 3)
+        self.base.append(Item(11))
+        self.assertEqual(self.numbers(self.filtered), [5, 7, 9, 11])
+        self.base.sort(key=lambda f: -f.n)
+        self.assertEqual(self.numbers(self.filtered), [11, 9, 7, 5])
+        del self.base[0]
+        self.assertEqual(len(self.filtered), 3)
+        unique, scans_in_each = self.filtered.get_unique_metadata()
+        self.assertEqual(len(scans_in_each[0]), 1)
+
+
+if __name__ == '__main__':
+    test_all()
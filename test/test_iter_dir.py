@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, shutil, tempfile
+
+from dinoteeth_test import *
+
+from dinoteeth.utils import iter_dir, iter_dir_stat, iter_subdirs
+
+class TestIterDir(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ["a.mkv", "b.avi", "notes.txt",
+                     "sub/c.mkv", "sub/deeper/d.mkv",
+                     "sub.old/e.mkv", "extras/f.mkv",
+                     "._a.mkv", ".hidden/g.mkv", "sub/.thumbnails/h.mkv"]:
+            pathname = os.path.join(self.root, name)
+            dirname = os.path.dirname(pathname)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            open(pathname, "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def names(self, iterable):
+        return sorted(os.path.relpath(p, self.root) for p in iterable)
+
+    def testFlat(self):
+        self.assertEqual(self.names(iter_dir(self.root)), ["a.mkv", "b.avi", "notes.txt"])
+        self.assertEqual(self.names(iter_dir(self.root, [".mkv", ".avi"])), ["a.mkv", "b.avi"])
+
+    def testRecurse(self):
+        found = self.names(iter_dir(self.root, [".mkv"], recurse=True))
+        self.assertEqual(found, ["a.mkv", "extras/f.mkv", "sub/c.mkv", "sub/deeper/d.mkv"])
+
+    def testExclude(self):
+        found = self.names(iter_dir(self.root, [".mkv"], exclude="extras", recurse=True))
+        self.assertEqual(found, ["a.mkv", "sub/c.mkv", "sub/deeper/d.mkv"])
+        found = self.names(iter_dir(self.root, [".mkv"], exclude=["extras", "deeper"], recurse=True))
+        self.assertEqual(found, ["a.mkv", "sub/c.mkv"])
+
+    def testHidden(self):
+        found = self.names(iter_dir(self.root, recurse=True))
+        self.assertEqual([name for name in found if "/." in "/" + name], [])
+
+    def testStat(self):
+        for pathname, stat_result in iter_dir_stat(self.root, [".mkv"], recurse=True):
+            self.assertEqual(os.stat(pathname).st_ino, stat_result.st_ino)
+
+    def testSubdirs(self):
+        self.assertEqual(self.names(iter_subdirs(self.root)), ["extras", "sub", "sub.old"])
+
+
+if __name__ == '__main__':
+    test_all()
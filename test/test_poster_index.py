@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, shutil, tempfile
+
+from dinoteeth_test import *
+
+from dinoteeth.metadata import PosterIndex
+
+class TestPosterIndex(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ["tt0001.jpg", "tt0001.png", "tt0002.gif", "tt0002.png",
+                     "tt0003-s01.jpg", "tt0004.txt"]:
+            open(os.path.join(self.root, name), "w").close()
+        self.index = PosterIndex()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def testPriority(self):
+        self.assertEqual(self.index.find(self.path("tt0001")), self.path("tt0001.jpg"))
+        self.assertEqual(self.index.find(self.path("tt0002")), self.path("tt0002.png"))
+        self.assertEqual(self.index.find(self.path("tt0003-s01")), self.path("tt0003-s01.jpg"))
+        self.assertEqual(self.index.find(self.path("tt0004")), None)
+        self.assertEqual(self.index.find(self.path("missing/tt0001")), None)
+
+    def testAdd(self):
+        self.assertEqual(self.index.find(self.path("tt0005")), None)
+        open(self.path("tt0005.png"), "w").close()
+        self.index.add(self.path("tt0005.png"))
+        self.assertEqual(self.index.find(self.path("tt0005")), self.path("tt0005.png"))
+        self.index.add(self.path("tt0001.gif"))
+        self.assertEqual(self.index.find(self.path("tt0001")), self.path("tt0001.jpg"))
+
+    def testInvalidate(self):
+        self.index.check_interval = 0
+        self.assertEqual(self.index.find(self.path("tt0006")), None)
+        open(self.path("tt0006.jpg"), "w").close()
+        mtime = os.stat(self.root).st_mtime
+        os.utime(self.root, (mtime + 10, mtime + 10))
+        self.assertEqual(self.index.find(self.path("tt0006")), self.path("tt0006.jpg"))
+
+    def testMtime(self):
+        self.assertEqual(self.index.get_mtime(self.root), os.stat(self.root).st_mtime)
+        self.assertEqual(self.index.get_mtime(self.path("missing")), None)
+        mtime = int(os.stat(self.root).st_mtime)
+        open(self.path("tt0007.jpg"), "w").close()
+        os.utime(self.root, (mtime + 10, mtime + 10))
+        self.index.add(self.path("tt0007.jpg"))
+        self.assertEqual(self.index.get_mtime(self.root), mtime + 10)
+
+
+if __name__ == '__main__':
+    test_all()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from dinoteeth_test import *
+
+from dinoteeth.database import TitleSearchIndex
+
+class MockMetadata(object):
+    def __init__(self, id, title):
+        self.id = id
+        self.title = title
+
+class TestTitleSearchIndex(TestCase):
+    def setUp(self):
+        titles = ["The Hunt for Red October", "Red Dawn", "The Social Network",
+                  "Network", "Up", None]
+        self.index = TitleSearchIndex([MockMetadata(i, t) for i, t in enumerate(titles)])
+
+    def testShort(self):
+        self.assertEqual(self.index.search("up"), set([4]))
+        self.assertEqual(self.index.search(""), set(range(6)))
+
+    def testTrigrams(self):
+        self.assertEqual(self.index.search("red"), set([0, 1]))
+        self.assertEqual(self.index.search("NETWORK"), set([2, 3]))
+        self.assertEqual(self.index.search("e s"), set([2]))
+        self.assertEqual(self.index.search("xyz"), set())
+
+    def testNarrowing(self):
+        ids = self.index.search("re")
+        self.assertEqual(ids, set([0, 1]))
+        self.assertEqual(self.index.search("red d", ids), set([1]))
+
+    def testByteStrings(self):
+        index = TitleSearchIndex([MockMetadata(0, "Caf\xc3\xa9 Society"), MockMetadata(1, "Bad \xff byte")])
+        self.assertEqual(index.search(u"caf\xe9"), set([0]))
+        self.assertEqual(index.search("CAF\xc3\xa9 s"), set([0]))
+        self.assertEqual(index.search("bad"), set([1]))
+
+
+if __name__ == '__main__':
+    test_all()